@@ -1,13 +1,21 @@
+import hashlib
 import json
 import logging
+import os
 import requests
+import time
 
 from base64 import b64encode
 from datetime import datetime, timezone
-from time import sleep
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode
 
+from autotoggl.ratelimit import TokenBucket
 
-API_BASE = 'https://www.toggl.com/api/v8/'
+
+# May be overridden, e.g. to use autotoggl.mockserver for testing
+API_BASE = os.environ.get(
+    'AUTOTOGGL_API_BASE', 'https://www.toggl.com/api/v8/')
 
 
 def _init_logger(name=__file__, level=logging.INFO):
@@ -28,23 +36,88 @@ class ApiError(Exception):
     pass
 
 
+def _isoformat(timestamp) -> str:
+    return (datetime.fromtimestamp(timestamp, timezone.utc)
+            .astimezone()
+            .isoformat())
+
+
+def _retry_after(response, default=1.0) -> float:
+    '''
+    Parse the Retry-After header of a response, which may be a number of
+    seconds or an HTTP date.
+    '''
+    value = response.headers.get('Retry-After')
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(
+            0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+
 class TogglApiInterface:
-    def __init__(self, config, mock=False):
+    def __init__(self, config, mock=False, cache_file=None, metrics=None):
 
         # If true, network requests will be disabled and empty data
         # will be returned
         self.mock = mock
 
+        # Workspaces and projects are saved to this file and reused
+        # until they are older than cache_ttl seconds
+        self.cache_file = cache_file
+        self.cache_ttl = config.project_cache_ttl
+
+        # True once workspaces and projects have been fetched from the
+        # API during this run
+        self.refreshed = False
+
         self.default_workspace = config.default_workspace
 
+        self.api_base = config.api_base or API_BASE
+
         self.api_token = b64encode(
             (config.api_key + ':api_token').encode()).decode()
 
+        # Identifies the server and account that the cache file was
+        # saved from, so that ids from e.g. autotoggl.mockserver are never
+        # used with the real API. The token itself is not saved.
+        self.cache_key = hashlib.sha1(
+            (self.api_base + '\n' + self.api_token).encode()).hexdigest()
+
         self.headers = {
             'Authorization': 'Basic ' + self.api_token,
             'Content-Type': 'application/json'
         }
 
+        # A single keep-alive session is shared by all requests so that
+        # each one does not need a new TLS connection
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+
+        # Keep a connection open for each concurrent submission
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=max(10, config.submit_concurrency))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.limiter = TokenBucket(
+            rate=config.api_requests_per_second,
+            capacity=config.api_burst)
+
+        # How many times a request is retried after HTTP 429
+        self.max_retries = 5
+
+        # Optional autotoggl.metrics.Metrics which counts requests,
+        # bytes sent, retries and time spent waiting for the limiter
+        self.metrics = metrics
+
         self.cached = {
             # 'workspace_id': {
             #     'project_id' {
@@ -127,6 +200,69 @@ class TogglApiInterface:
             projects += self.get_projects(w['id']) or []
         return projects
 
+    def ensure_projects(self):
+        '''
+        Make sure workspaces and projects are available, from the cache
+        file if it is fresh enough or otherwise from the API.
+        '''
+        if self.projects or self.load_cache():
+            return
+        self.refresh_projects()
+
+    def refresh_projects(self):
+        '''
+        Fetch all workspaces and projects from the API and save them to
+        the cache file.
+        '''
+        self.get_all_projects()
+        self.refreshed = True
+        self.save_cache()
+
+    def load_cache(self) -> bool:
+        '''
+        Load workspaces and projects from the cache file.
+        Returns False if there is no cache, it has expired, or it was
+        saved for a different api_base or API key.
+        '''
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return False
+        try:
+            with open(self.cache_file, 'r') as f:
+                j = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning('Unable to read project cache: {}'.format(e))
+            return False
+
+        if j.get('key') != self.cache_key:
+            logger.debug('Project cache is for another server or account')
+            return False
+
+        age = time.time() - j.get('fetched_at', 0)
+        if age > self.cache_ttl:
+            logger.debug('Project cache has expired')
+            return False
+
+        self.cached = j.get('cached', {})
+        self.projects = j.get('projects', {})
+        if self.cached:
+            self._set_default_workspace()
+        logger.debug('Loaded {} projects from cache'.format(len(self.projects)))
+        return True
+
+    def save_cache(self):
+        if not self.cache_file or self.mock:
+            return
+        try:
+            with open(self.cache_file, 'w') as f:
+                json.dump({
+                    'key': self.cache_key,
+                    'fetched_at': time.time(),
+                    'cached': self.cached,
+                    'projects': self.projects,
+                }, f)
+        except OSError as e:
+            logger.warning('Unable to write project cache: {}'.format(e))
+
     def create_project(self, project_name, workspace_id=None):
         '''
         Create a new project on the given (or default) workspace
@@ -145,6 +281,7 @@ class TogglApiInterface:
         })
         logger.debug(j)
         self._cache_projects([j['data']])
+        self.save_cache()
 
         return j
 
@@ -163,9 +300,7 @@ class TogglApiInterface:
 
         logger.debug('Creating time entry')
 
-        start = (datetime.fromtimestamp(start_timestamp, timezone.utc)
-                 .astimezone()
-                 .isoformat())
+        start = _isoformat(start_timestamp)
 
         j = self._post('time_entries', {
                 'time_entry': {
@@ -180,43 +315,70 @@ class TogglApiInterface:
         logger.debug(j)
         return j
 
+    def get_time_entries(self, start_timestamp, end_timestamp):
+        '''
+        Get all time entries which started within the given range
+        '''
+        return self._get('time_entries?' + urlencode({
+            'start_date': _isoformat(start_timestamp),
+            'end_date': _isoformat(end_timestamp),
+        }))
+
     def _get(self, url_stub):
         if self.mock:
             return {}
 
-        r = requests.get(
-            API_BASE + url_stub,
-            headers=self.headers,
-        )
-        self._show_response(r)
-        sleep(1)
+        r = self._request('GET', url_stub)
         return r.json()
 
     def _post(self, url_stub, data):
         if self.mock:
             return {}
 
-        r = requests.post(
-            API_BASE + url_stub,
-            headers=self.headers,
-            data=json.dumps(data),
-        )
-        self._show_response(r)
-        sleep(1)
+        r = self._request('POST', url_stub, data=json.dumps(data))
         return r.json()
 
     def _delete(self, url_stub):
         if self.mock:
             return True
 
-        r = requests.delete(
-            API_BASE + url_stub,
-            headers=self.headers,
-        )
-        self._show_response(r)
-        sleep(1)
+        r = self._request('DELETE', url_stub)
         return r.status_code == 200
 
+    def _request(self, method, url_stub, **kwargs):
+        '''
+        Send a request once the rate limiter allows it. If the server
+        responds with HTTP 429 then all requests are held back for its
+        Retry-After period and this one is tried again.
+        '''
+        for attempt in range(self.max_retries + 1):
+            waited = self.limiter.acquire()
+            r = self.session.request(
+                method, self.api_base + url_stub, **kwargs)
+
+            if self.metrics is not None:
+                self.metrics.count('api_requests')
+                self.metrics.count('api_rate_limit_wait_seconds', waited)
+                self.metrics.count(
+                    'api_bytes_sent', len(kwargs.get('data') or ''))
+                self.metrics.count('api_bytes_received', len(r.content))
+                if r.status_code == 429 and attempt < self.max_retries:
+                    self.metrics.count('api_retries')
+                elif r.status_code >= 400:
+                    self.metrics.count('api_errors')
+
+            if r.status_code == 429 and attempt < self.max_retries:
+                wait = _retry_after(r, default=2 ** attempt)
+                logger.warning(
+                    '[429] {} - retrying in {}s'.format(r.request.url, wait))
+                self.limiter.backoff(wait)
+                continue
+
+            if r.status_code != 429:
+                self.limiter.succeeded()
+            self._show_response(r)
+            return r
+
     def _show_response(self, r):
         logger.info('[{}] {}'.format(r.status_code, r.request.url))
         if r.status_code >= 400:
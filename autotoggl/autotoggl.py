@@ -3,26 +3,196 @@ import json
 import logging
 import os
 import sqlite3
+import sys
 import time
 
+import requests
+
 import autotoggl.render
+import autotoggl.vectorized
 
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import timedelta
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, Tuple
 
-from autotoggl.config import Config
+from autotoggl.config import Config, JOURNAL_MODES, SYNCHRONOUS
+from autotoggl.planner import plan_entries
+from autotoggl.reconcile import reconcile
 from autotoggl.api import TogglApiInterface, ApiError
+from autotoggl.metrics import Metrics
+from autotoggl.profiling import Profiler
+from autotoggl.tracing import QueryTracer
+from autotoggl.cache import ClassificationStore, ClassifierCache
 from autotoggl.util import midnight
 
 
 BASE_DIR = os.path.expanduser('~/autotoggl/')
 DB_PATH = os.path.join(BASE_DIR, 'toggl.db')
 CONFIG_FILE = os.path.join(BASE_DIR, 'config.json')
+PROJECTS_CACHE_FILE = os.path.join(BASE_DIR, 'projects.json')
 
 # Special event name indicating that system status has changed
 # Triggered by events such as user idle, system lock
 EVENT_SYSTEM = '__SYS__'
 
+# Schema migrations, applied in order by DatabaseManager. The database
+# schema version is stored in PRAGMA user_version and each entry in this
+# list upgrades it by one. Existing entries must never be edited or
+# reordered - add a new entry instead. New entries must not assume that
+# toggl is a table, as it is a view once a database is normalized.
+MIGRATIONS = [
+    # 1: Every range query filters on start
+    [
+        '''CREATE INDEX IF NOT EXISTS toggl_start ON toggl (start)''',
+    ],
+    # 2: Pending work is looked up via rows that have not been consumed
+    [
+        '''CREATE INDEX IF NOT EXISTS toggl_unconsumed
+           ON toggl (start) WHERE consumed=0''',
+    ],
+    # 3: Planned time entries and their submission state
+    [
+        '''CREATE TABLE IF NOT EXISTS outbox
+           (event_id INTEGER PRIMARY KEY,
+           merged TEXT NOT NULL,
+           project TEXT NOT NULL,
+           description TEXT,
+           start INTEGER NOT NULL,
+           duration INTEGER NOT NULL,
+           tags TEXT NOT NULL,
+           state TEXT NOT NULL DEFAULT 'pending',
+           attempts INTEGER NOT NULL DEFAULT 0,
+           next_attempt INTEGER NOT NULL DEFAULT 0,
+           last_error TEXT)''',
+        '''CREATE INDEX IF NOT EXISTS outbox_state
+           ON outbox (state, next_attempt)''',
+    ],
+    # 4: Space freed by deleting old events is reclaimed a few pages at
+    # a time by incremental_vacuum, instead of rewriting the whole file.
+    # Existing databases need a one-off VACUUM for this to take effect.
+    [
+        '''PRAGMA auto_vacuum=INCREMENTAL''',
+        '''VACUUM''',
+    ],
+]
+
+# Normalized storage, enabled by DatabaseManager(normalize=True). Each
+# distinct process name and window title is stored once, and events refer
+# to them by integer id. toggl is replaced by a view with the same
+# columns plus rowid, and triggers which redirect writes to the new
+# tables, so statements written for the original table keep working as
+# long as INSERTs name their columns. Event ids are kept unchanged.
+NORMALIZE = [
+    '''CREATE TABLE processes
+       (id INTEGER PRIMARY KEY,
+       name TEXT NOT NULL UNIQUE)''',
+    '''CREATE TABLE titles
+       (id INTEGER PRIMARY KEY,
+       title TEXT NOT NULL UNIQUE)''',
+    '''CREATE TABLE events
+       (id INTEGER PRIMARY KEY,
+       process_id INTEGER NOT NULL REFERENCES processes (id),
+       title_id INTEGER NOT NULL REFERENCES titles (id),
+       start INTEGER NOT NULL,
+       consumed BOOLEAN NOT NULL DEFAULT 0)''',
+    '''INSERT INTO processes (name)
+       SELECT DISTINCT process_name FROM toggl''',
+    '''INSERT INTO titles (title)
+       SELECT DISTINCT window_title FROM toggl''',
+    '''INSERT INTO events
+       SELECT toggl.rowid, processes.id, titles.id, start, consumed
+       FROM toggl
+       JOIN processes ON processes.name=toggl.process_name
+       JOIN titles ON titles.title=toggl.window_title''',
+    '''DROP TABLE toggl''',
+    '''CREATE INDEX events_start ON events (start)''',
+    '''CREATE INDEX events_unconsumed ON events (start) WHERE consumed=0''',
+    '''CREATE VIEW toggl
+       (rowid, process_name, window_title, start, consumed) AS
+       SELECT events.id, processes.name, titles.title,
+              events.start, events.consumed
+       FROM events
+       JOIN processes ON processes.id=events.process_id
+       JOIN titles ON titles.id=events.title_id''',
+    '''CREATE TRIGGER toggl_insert INSTEAD OF INSERT ON toggl
+       BEGIN
+           INSERT OR IGNORE INTO processes (name)
+           VALUES (NEW.process_name);
+           INSERT OR IGNORE INTO titles (title)
+           VALUES (NEW.window_title);
+           INSERT INTO events (process_id, title_id, start, consumed)
+           VALUES (
+               (SELECT id FROM processes WHERE name=NEW.process_name),
+               (SELECT id FROM titles WHERE title=NEW.window_title),
+               NEW.start,
+               COALESCE(NEW.consumed, 0));
+       END''',
+    '''CREATE TRIGGER toggl_update INSTEAD OF UPDATE OF consumed ON toggl
+       BEGIN
+           UPDATE events SET consumed=NEW.consumed WHERE id=OLD.rowid;
+       END''',
+    '''CREATE TRIGGER toggl_delete INSTEAD OF DELETE ON toggl
+       BEGIN
+           DELETE FROM events WHERE id=OLD.rowid;
+       END''',
+]
+
+# Inserts into toggl name their columns so that they also work with
+# the view used by normalized storage
+INSERT_EVENT = '''INSERT INTO toggl
+                  (process_name, window_title, start, consumed)
+                  VALUES (?, ?, ?, ?)'''
+
+
+class ConnectionProfile:
+    '''
+    PRAGMAs applied to every connection opened by DatabaseManager.
+
+    The defaults use write-ahead logging so that the collector can keep
+    committing while a long read, e.g. -catchup, is in progress, and
+    synchronous=NORMAL so that commits do not wait for an fsync. In WAL
+    mode a power failure can lose the last few commits but cannot
+    corrupt the database.
+    '''
+
+    def __init__(self, journal_mode='wal', synchronous='normal',
+                 mmap_bytes=256 * 1024 * 1024, cache_kib=16 * 1024,
+                 busy_timeout_seconds=5.0):
+        # Both are formatted into PRAGMA statements
+        if journal_mode.lower() not in JOURNAL_MODES:
+            raise ValueError('Unknown journal mode: {}'.format(journal_mode))
+        if synchronous.lower() not in SYNCHRONOUS:
+            raise ValueError(
+                'Unknown synchronous setting: {}'.format(synchronous))
+
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.mmap_bytes = mmap_bytes
+        self.cache_kib = cache_kib
+        self.busy_timeout_seconds = busy_timeout_seconds
+
+    @classmethod
+    def from_config(cls, config) -> 'ConnectionProfile':
+        return cls(
+            journal_mode=config.db_journal_mode,
+            synchronous=config.db_synchronous,
+            mmap_bytes=config.db_mmap_bytes,
+            cache_kib=config.db_cache_kib,
+            busy_timeout_seconds=config.db_busy_timeout_seconds)
+
+    def apply(self, conn) -> None:
+        # busy_timeout is set first so that changing the journal mode
+        # waits for any other connection to finish
+        conn.execute('''PRAGMA busy_timeout={:d}'''.format(
+            int(self.busy_timeout_seconds * 1000)))
+        conn.execute('''PRAGMA journal_mode={}'''.format(self.journal_mode))
+        conn.execute('''PRAGMA synchronous={}'''.format(self.synchronous))
+        conn.execute('''PRAGMA mmap_size={:d}'''.format(self.mmap_bytes))
+
+        # A negative cache_size is in KiB rather than pages
+        conn.execute('''PRAGMA cache_size={:d}'''.format(-self.cache_kib))
+
 
 def _init_logger(name=__file__, level=logging.DEBUG) -> logging.Logger:
     logger = logging.getLogger(name)
@@ -35,6 +205,19 @@ logger = _init_logger()
 
 
 class Event:
+    __slots__ = (
+        'id',
+        'process',
+        'title',
+        'start',
+        'consumed',
+        'project',
+        'description',
+        'duration',
+        '_tags',
+        '_merged',
+    )
+
     def __init__(self, **kwargs):
         self.id = kwargs.get('id')
         self.process = kwargs.get('process')
@@ -42,30 +225,196 @@ class Event:
         self.start = kwargs.get('start')
         self.consumed = kwargs.get('consumed', False)
         self.project = kwargs.get('project')
-        self.tags = kwargs.get('tags', [])
         self.description = kwargs.get('description')
 
         self.duration = kwargs.get('duration', 0)
 
-        self.merged = []
+        # Most events are discarded or merged during compression, so
+        # these lists are only allocated when they are first accessed
+        self._tags = kwargs.get('tags')
+        self._merged = None
+
+    @property
+    def tags(self) -> list:
+        if self._tags is None:
+            self._tags = []
+        return self._tags
+
+    @tags.setter
+    def tags(self, tags) -> None:
+        self._tags = tags
+
+    @property
+    def merged(self) -> List[int]:
+        if self._merged is None:
+            self._merged = []
+        return self._merged
 
     def merge(self, other) -> None:
         self.duration += other.duration
         other.duration = 0
         self.merged.append(other.id)
 
+    def as_json(self) -> dict:
+        return {
+            'id': self.id,
+            'process': self.process,
+            'title': self.title,
+            'start': self.start,
+            'consumed': self.consumed,
+            'project': self.project,
+            'tags': self.tags,
+            'description': self.description,
+            'duration': self.duration,
+            'merged': self.merged,
+        }
+
     def __repr__(self):
-        return json.dumps(self.__dict__, indent=2, sort_keys=True)
+        return json.dumps(self.as_json(), indent=2, sort_keys=True)
+
+
+class EventBatch:
+    '''
+    Compact, column-oriented collection of events for long ranges such
+    as catch-up runs.
+
+    Ids, start times and durations are held in typed arrays, process
+    names and window titles are interned, and classifier results are
+    shared between rows. Event objects are only built when the batch is
+    iterated or indexed, so any pipeline function that accepts a list
+    of events also accepts an EventBatch.
+    '''
+    __slots__ = (
+        'ids',
+        'starts',
+        'durations',
+        'consumed',
+        'processes',
+        'titles',
+        'results',
+    )
+
+    def __init__(self):
+        self.ids = array('q')
+        self.starts = array('q')
+        self.durations = array('q')
+        self.consumed = bytearray()
+        self.processes = []
+        self.titles = []
+
+        # ClassifierResult (or None) for each row
+        self.results = []
+
+    @classmethod
+    def from_rows(cls, rows) -> 'EventBatch':
+        '''
+        Build a batch from (rowid, process_name, window_title,
+        start, consumed) rows.
+        '''
+        batch = cls()
+        batch.extend(rows)
+        return batch
+
+    def extend(self, rows) -> None:
+        '''Append (rowid, process_name, window_title, start, consumed) rows'''
+        for r in rows:
+            self.append(r[0], r[1], r[2], r[3], r[4])
+
+    def tail(self, n) -> 'EventBatch':
+        '''Return a new batch holding the rows from index n onwards'''
+        batch = EventBatch()
+        batch.ids = self.ids[n:]
+        batch.starts = self.starts[n:]
+        batch.durations = self.durations[n:]
+        batch.consumed = self.consumed[n:]
+        batch.processes = self.processes[n:]
+        batch.titles = self.titles[n:]
+        batch.results = self.results[n:]
+        return batch
+
+    def append(self, id, process, title, start, consumed=False,
+               duration=0) -> None:
+        self.ids.append(id)
+        self.starts.append(int(start))
+        self.durations.append(int(duration))
+        self.consumed.append(1 if consumed else 0)
+        self.processes.append(sys.intern(process) if process else process)
+        self.titles.append(sys.intern(title) if title else title)
+        self.results.append(None)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, n) -> Event:
+        result = self.results[n]
+        return Event(
+            id=self.ids[n],
+            process=self.processes[n],
+            title=self.titles[n],
+            start=self.starts[n],
+            consumed=bool(self.consumed[n]),
+            duration=self.durations[n],
+            project=result.project if result else None,
+            description=result.description if result else None,
+            tags=result.tags if result else None,
+        )
+
+    def __iter__(self) -> Iterator[Event]:
+        for n in range(len(self.ids)):
+            yield self[n]
+
+    def categorise(self, cache) -> None:
+        '''Store the classifier result for every row'''
+        get = cache.get
+        self.results = [
+            get(p, t) for p, t in zip(self.processes, self.titles)]
+
+    def sort(self) -> None:
+        '''Ensure rows are in order of occurrence'''
+        starts = self.starts
+        if all(starts[n] <= starts[n + 1] for n in range(len(starts) - 1)):
+            return
+
+        order = sorted(range(len(starts)), key=starts.__getitem__)
+        for name in ('ids', 'starts', 'durations'):
+            column = getattr(self, name)
+            sorted_column = array(column.typecode, [column[n] for n in order])
+            setattr(self, name, sorted_column)
+        self.consumed = bytearray(self.consumed[n] for n in order)
+        for name in ('processes', 'titles', 'results'):
+            column = getattr(self, name)
+            setattr(self, name, [column[n] for n in order])
 
 
 class DatabaseManager:
-    def __init__(self, filename=DB_PATH):
+    def __init__(self, filename=DB_PATH, tracer=None, profile=None,
+                 normalize=False):
         if not os.path.exists(filename):
             self._create(filename)
-        self.conn = sqlite3.connect(filename)
+        self.profile = profile or ConnectionProfile()
+        self.conn = sqlite3.connect(
+            filename, timeout=self.profile.busy_timeout_seconds)
+        self.profile.apply(self.conn)
         self.cursor = self.conn.cursor()
         self.alive = True
 
+        # Optional autotoggl.tracing.QueryTracer which records the
+        # statements run by exec and exec_many
+        self.tracer = tracer
+
+        self._migrate()
+
+        # Once a database has been normalized it stays that way,
+        # whatever normalize is set to
+        self.normalized = self._is_normalized()
+        if normalize and not self.normalized:
+            self._normalize()
+
+        # Interned process names and window titles by id, for reading
+        # normalized events
+        self._names = {}
+        self._titles = {}
+
     def __enter__(self):
         return self
 
@@ -91,6 +440,49 @@ class DatabaseManager:
         conn.commit()
         conn.close()
 
+    def _migrate(self) -> None:
+        '''
+        Upgrade the database schema in place to the latest version.
+        Each migration is applied in its own transaction along with
+        the new version number. VACUUM cannot run inside a transaction,
+        so it is run once the rest of its migration has been committed.
+        '''
+        version = self.conn.execute('''PRAGMA user_version''').fetchone()[0]
+        for n, statements in enumerate(MIGRATIONS[version:], version + 1):
+            logger.info('Migrating database to version {}'.format(n))
+            self.conn.execute('''BEGIN''')
+            try:
+                for sql in statements:
+                    if sql != '''VACUUM''':
+                        self.conn.execute(sql)
+                self.conn.execute('''PRAGMA user_version={}'''.format(n))
+            except Exception:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+
+            if '''VACUUM''' in statements:
+                self.conn.execute('''VACUUM''')
+
+    def _is_normalized(self) -> bool:
+        r = self.conn.execute(
+            '''SELECT type FROM sqlite_master WHERE name=?''',
+            ('toggl',)).fetchone()
+        return r is not None and r[0] == 'view'
+
+    def _normalize(self) -> None:
+        logger.info('Converting database to normalized storage')
+        self.conn.execute('''BEGIN''')
+        try:
+            for sql in NORMALIZE:
+                self.conn.execute(sql)
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        self.normalized = True
+        self.incremental_vacuum()
+
     def close(self, commit=True) -> None:
         if not self.alive:
             raise Exception(
@@ -107,14 +499,40 @@ class DatabaseManager:
                 'Cannot execute query: database connection '
                 'has already been closed.')
         try:
-            logger.info(f"exec: {args}")
-            return self.cursor.execute(*args)
+            if self.tracer is None:
+                return self.cursor.execute(*args)
+            return self.tracer.execute(self.cursor.execute, *args)
         except Exception as e:
             logger.error(
                 'Unable to execute query {args}: {err}'
                 .format(args=args, err=e))
 
-    def clean_up(self, **kwargs) -> None:
+    def exec_many(self, sql, seq_of_parameters) -> sqlite3.Cursor:
+        '''
+        Execute sql once for each set of parameters. Unlike exec, errors
+        are raised so that a failed batch can be rolled back.
+        '''
+        if not self.alive:
+            raise Exception(
+                'Cannot execute query: database connection '
+                'has already been closed.')
+        try:
+            if self.tracer is None:
+                return self.cursor.executemany(sql, seq_of_parameters)
+            return self.tracer.execute(
+                self.cursor.executemany, sql, seq_of_parameters, many=True)
+        except Exception as e:
+            logger.error(
+                'Unable to execute query {sql}: {err}'
+                .format(sql=sql, err=e))
+            raise
+
+    def clean_up(self, chunk_size=1000, **kwargs) -> int:
+        '''
+        Delete old events in transactions of at most chunk_size rows, so
+        that the collector is never locked out for long, then return the
+        freed pages to the filesystem. Returns the number deleted.
+        '''
         clear_all = kwargs.get('all', False)
         older_than_days = kwargs.get('older_than', 2)
         before = kwargs.get('before')
@@ -124,78 +542,404 @@ class DatabaseManager:
                               - timedelta(days=older_than_days))
 
         logger.warning('Removing events before {}'.format(before.isoformat()))
-        before_timestamp = before.timestamp()
-        if clear_all:
-            sql = '''DELETE FROM toggl WHERE start<?'''
-            self.exec(sql, (before_timestamp,))
-        else:
-            sql = '''DELETE FROM toggl WHERE start<? AND consumed=?'''
-            self.exec(sql, (before_timestamp, True))
+        deleted = 0
+        while True:
+            n = self.delete_events_before(
+                before, include_pending=clear_all, limit=chunk_size)
+            deleted += n
+            if n < chunk_size:
+                break
 
-        changes = self.exec('''SELECT changes()''').fetchone()[0]
+        with self.conn:
+            self.exec(
+                '''DELETE FROM outbox WHERE state='submitted' AND start<?''',
+                (before.timestamp(),))
 
-        self.exec('''VACUUM''')  # Free up space
-        logger.info('Deleted {} events'.format(changes))
+        pages = self.incremental_vacuum()
+        logger.info('Deleted {} events, freeing {} pages'.format(
+            deleted, pages))
+        return deleted
 
-    def consume(self, events) -> None:
+    def delete_events_before(self, before, include_pending=False,
+                             limit=1000) -> int:
+        '''
+        Delete up to limit events that started before the given
+        datetime in a single transaction. Events which have not been
+        consumed are kept unless include_pending is True. Returns the
+        number of events deleted.
+        '''
+        # Rows changed by the view's triggers are not counted, so
+        # normalized events are deleted from their own table
+        table, id = ('events', 'id') if self.normalized else ('toggl', 'rowid')
+        sql = '''DELETE FROM {table} WHERE {id} IN
+                 (SELECT {id} FROM {table} WHERE start<? {pending} LIMIT ?)'''
+        sql = sql.format(
+            table=table, id=id,
+            pending='' if include_pending else 'AND consumed=1')
+        with self.conn:
+            c = self.exec(sql, (before.timestamp(), limit))
+        return c.rowcount if c else 0
+
+    def incremental_vacuum(self, pages=0) -> int:
+        '''
+        Return up to `pages` free pages to the filesystem, or all of
+        them if pages is 0. Returns the number of pages freed.
+        '''
+        free = self.exec('''PRAGMA freelist_count''').fetchone()[0]
+        # execute() would only step the pragma once, freeing one page.
+        # executescript() runs it to completion, after committing any
+        # pending transaction.
+        self.conn.executescript(
+            '''PRAGMA incremental_vacuum({:d});'''.format(pages))
+        return free - self.exec('''PRAGMA freelist_count''').fetchone()[0]
+
+    def consume(self, events) -> int:
         '''
         Mark the given events (and any events merged with them) as consumed,
-        meaning they have been submitted to Toggl successfully
+        meaning they have been submitted to Toggl successfully.
+
+        All rows are updated in a single transaction. Returns the number
+        of rows affected.
         '''
-        ids = []
+        ids = {}
         for e in events:
             if e.consumed:
-                ids += e.merged
-                ids.append(e.id)
-        sql = '''UPDATE toggl SET consumed=? WHERE rowid=?'''
-        for rowid in ids:
-            self.exec(sql, (True, rowid))
+                ids.update(dict.fromkeys(e.merged))
+                ids[e.id] = None
+        if not ids:
+            return 0
+
+        if self.normalized:
+            sql = '''UPDATE events SET consumed=1 WHERE id=?'''
+        else:
+            sql = '''UPDATE toggl SET consumed=1 WHERE rowid=?'''
+        with self.conn:
+            c = self.exec_many(sql, [(rowid,) for rowid in ids])
+        logger.info('Consumed {} events'.format(c.rowcount))
+        return c.rowcount
 
     def get_events(self, start_datetime, end_datetime) -> List[Event]:
-        c = self.exec(
-            '''SELECT rowid, process_name, window_title, start, consumed
-               FROM toggl WHERE start>=? AND start<=?''',
-            (start_datetime.timestamp(), end_datetime.timestamp()))
+        return list(self.iter_events(start_datetime, end_datetime))
+
+    def get_event_batch(self, start_datetime, end_datetime,
+                        batch=None) -> EventBatch:
+        '''
+        Return events in a compact EventBatch, for long ranges where
+        a list of Event objects would use too much memory. If `batch` is
+        given the events are appended to it.
+        '''
+        rows = self._iter_rows(start_datetime, end_datetime)
+        if batch is None:
+            return EventBatch.from_rows(rows)
+
+        batch.extend(rows)
+        return batch
+
+    def pending_days(self, end_datetime,
+                     day_ends_at=3) -> List[datetime.datetime]:
+        '''
+        Return the start of each day up to end_datetime which has events
+        that have not been consumed, oldest first. Only unconsumed rows
+        are read, via their partial index, so days which have been fully
+        consumed cost nothing however much history there is.
+        '''
+        sql = '''SELECT DISTINCT
+                 date(start, 'unixepoch', 'localtime', ?)
+                 FROM {} WHERE consumed=0 AND start<=?
+                 ORDER BY 1'''.format(
+            'events' if self.normalized else 'toggl')
+        r = self.exec(sql, (
+            '-{} hours'.format(day_ends_at), end_datetime.timestamp()))
         return [
-            Event(
+            datetime.datetime.strptime(day, '%Y-%m-%d').replace(
+                hour=day_ends_at)
+            for day, in r.fetchall()]
+
+    def iter_events(self, start_datetime, end_datetime,
+                    chunk_size=1000) -> Iterator[Event]:
+        '''
+        Yield events in order of occurrence, reading rows from the
+        database in chunks rather than all at once.
+        '''
+        for r in self._iter_rows(start_datetime, end_datetime, chunk_size):
+            yield Event(
                 id=r[0],
                 process=r[1],
                 title=r[2],
                 start=r[3],
                 consumed=bool(r[4]),
-            ) for r in c.fetchall()]
+            )
+
+    def _iter_rows(self, start_datetime, end_datetime,
+                   chunk_size=1000) -> Iterator[tuple]:
+        # Use a dedicated cursor so that other queries can be made
+        # while the results are being consumed
+        if self.normalized:
+            sql = '''SELECT id, process_id, title_id, start, consumed
+                     FROM events WHERE start>=? AND start<=?
+                     ORDER BY start'''
+        else:
+            sql = '''SELECT rowid, process_name, window_title, start, consumed
+                     FROM toggl WHERE start>=? AND start<=?
+                     ORDER BY start'''
+        parameters = (start_datetime.timestamp(), end_datetime.timestamp())
+        if self.tracer is None:
+            c = self.conn.execute(sql, parameters)
+        else:
+            c = self.tracer.execute(self.conn.execute, sql, parameters)
+        try:
+            rows = c.fetchmany(chunk_size)
+            while rows:
+                if self.normalized:
+                    yield from self._lookup_strings(rows)
+                else:
+                    yield from rows
+                rows = c.fetchmany(chunk_size)
+        finally:
+            c.close()
+
+    def _lookup_strings(self, rows) -> Iterator[tuple]:
+        '''
+        Replace process and title ids with their strings. Each distinct
+        string is interned and shared by every event that uses it.
+        '''
+        names = self._names
+        titles = self._titles
+        for r in rows:
+            if r[1] not in names or r[2] not in titles:
+                self._load_strings()
+            yield r[0], names[r[1]], titles[r[2]], r[3], r[4]
+
+    def _load_strings(self) -> None:
+        # New strings may have been added by another connection since
+        # they were last loaded, e.g. by the collector
+        for id, name in self.conn.execute(
+                '''SELECT id, name FROM processes'''):
+            self._names[id] = sys.intern(name)
+        for id, title in self.conn.execute(
+                '''SELECT id, title FROM titles'''):
+            self._titles[id] = sys.intern(title)
+
+    def insert_events(self, rows) -> None:
+        '''
+        Insert (process_name, window_title, start, consumed) rows in a
+        single transaction.
+        '''
+        with self.conn:
+            self.exec_many(INSERT_EVENT, rows)
+
+    def consume_range(self, start_datetime, end_datetime) -> int:
+        '''
+        Mark every event from start_datetime up to, but not including,
+        end_datetime as consumed. Used once every entry in a range has
+        been submitted, so that system events and rows which were not
+        part of any entry stop it from counting as pending.
+        Returns the number of rows affected.
+        '''
+        sql = '''UPDATE {}
+                 SET consumed=1
+                 WHERE consumed=0 AND start>=? AND start<?'''.format(
+            'events' if self.normalized else 'toggl')
+        with self.conn:
+            c = self.exec(
+                sql, (start_datetime.timestamp(), end_datetime.timestamp()))
+        return c.rowcount
 
     def reset(self, start_datetime, end_datetime) -> None:
-        sql = '''UPDATE toggl
+        sql = '''UPDATE {}
                  SET consumed=?
-                 WHERE start>=? AND start<=?'''
+                 WHERE start>=? AND start<=?'''.format(
+            'events' if self.normalized else 'toggl')
         self.exec(
             sql,
             (False, start_datetime.timestamp(), end_datetime.timestamp()))
 
 
+class Outbox:
+    '''
+    Durable record of planned time entries in toggl.db.
+
+    Every entry is saved before any requests are made, and its state is
+    committed as soon as its request completes, together with consuming
+    its events. If a run is interrupted then entries which Toggl already
+    accepted are not submitted again, and any that were not submitted
+    can be retried later without recomputing the day.
+    '''
+    PENDING = 'pending'
+    SUBMITTED = 'submitted'
+    FAILED = 'failed'
+
+    def __init__(self, db, retry_seconds=60, max_attempts=8):
+        self.db = db
+
+        # Failed entries wait retry_seconds * 2^(attempts - 1) before
+        # they are retried, and are abandoned after max_attempts
+        self.retry_seconds = retry_seconds
+        self.max_attempts = max_attempts
+
+    def plan(self, events) -> None:
+        '''
+        Record the given events as pending. Entries which have already
+        been submitted are left untouched.
+        '''
+        sql = '''INSERT INTO outbox
+                 (event_id, merged, project, description,
+                 start, duration, tags, state)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                 ON CONFLICT (event_id) DO UPDATE SET
+                    merged=excluded.merged,
+                    project=excluded.project,
+                    description=excluded.description,
+                    start=excluded.start,
+                    duration=excluded.duration,
+                    tags=excluded.tags,
+                    state=excluded.state,
+                    next_attempt=0
+                 WHERE state<>?'''
+        with self.db.conn:
+            self.db.exec_many(sql, [
+                (
+                    e.id,
+                    json.dumps(e.merged),
+                    e.project,
+                    e.description,
+                    e.start,
+                    e.duration,
+                    json.dumps(e.tags),
+                    Outbox.PENDING,
+                    Outbox.SUBMITTED,
+                ) for e in events])
+
+    def record(self, event, error=None) -> None:
+        '''
+        Save the outcome of submitting an event. A successful submission
+        also consumes the event, in the same transaction.
+        '''
+        if error is None:
+            self.db.exec(
+                '''UPDATE outbox
+                   SET state=?, attempts=attempts+1, last_error=NULL
+                   WHERE event_id=?''',
+                (Outbox.SUBMITTED, event.id))
+            n_consumed = self.db.consume([event])
+            n_expected = 1 + len(event.merged)
+            if n_consumed != n_expected:
+                logger.warning(
+                    'Expected to consume {} events but {} were updated'
+                    .format(n_expected, n_consumed))
+            return
+
+        self.db.exec(
+            '''UPDATE outbox
+               SET state=?, attempts=attempts+1, last_error=?,
+               next_attempt=? * (1 << attempts) + ?
+               WHERE event_id=?''',
+            (
+                Outbox.FAILED,
+                str(error),
+                self.retry_seconds,
+                int(time.time()),
+                event.id,
+            ))
+        self.db.conn.commit()
+
+    def due(self, now=None) -> List[Event]:
+        '''
+        Return entries which are waiting to be submitted or retried,
+        skipping any whose events have since been consumed.
+        '''
+        if now is None:
+            now = time.time()
+        c = self.db.exec(
+            '''SELECT event_id, merged, project, description,
+                      start, duration, tags
+               FROM outbox
+               WHERE state IN (?, ?) AND next_attempt<=? AND attempts<?
+               AND NOT EXISTS (
+                   SELECT 1 FROM toggl
+                   WHERE toggl.rowid=outbox.event_id AND consumed=1)
+               ORDER BY start''',
+            (Outbox.PENDING, Outbox.FAILED, now, self.max_attempts))
+
+        events = []
+        for r in c.fetchall():
+            e = Event(
+                id=r[0],
+                project=r[2],
+                description=r[3],
+                start=r[4],
+                duration=r[5],
+                tags=json.loads(r[6]))
+            e.merged.extend(json.loads(r[1]))
+            events.append(e)
+        return events
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self.db.exec(
+            '''SELECT state, COUNT(*) FROM outbox GROUP BY state'''
+        ).fetchall())
+
+
 def load_config() -> Config:
     return Config(CONFIG_FILE)
 
 
 def get_events_for_date(db, date, day_ends_at=3) -> List[Event]:
+    return list(iter_events_for_date(db, date, day_ends_at))
+
+
+def day_range(date, day_ends_at=3) -> Tuple:
     date_starts = date.replace(
         hour=day_ends_at, minute=0, second=0, microsecond=0)
-    date_ends = date_starts + timedelta(days=1)
+    return date_starts, date_starts + timedelta(days=1)
+
+
+def iter_events_for_date(db, date, day_ends_at=3) -> Iterator[Event]:
+    date_starts, date_ends = day_range(date, day_ends_at)
     logger.info(
         'Getting events between {} and {}'.format(date_starts, date_ends))
 
-    return db.get_events(date_starts, date_ends)
+    return db.iter_events(date_starts, date_ends)
 
 
 def get_events_until(db, date_ends, day_ends_at=3) -> List[Event]:
-    """Return all events that occurred before end of date_end."""
-    date_starts = datetime.datetime.fromtimestamp(1000000)
+    """Return events from every day before date_end with pending events."""
+    return list(iter_events_until(db, date_ends, day_ends_at))
+
+
+def iter_events_until(db, date_ends, day_ends_at=3) -> Iterator[Event]:
+    """
+    Yield events from each range returned by pending_ranges in turn.
+    Events on either side of a gap between ranges are not adjacent, so
+    ranges should be compressed separately, as run() does.
+    """
+    for date_starts, range_ends in pending_ranges(db, date_ends, day_ends_at):
+        yield from db.iter_events(date_starts, range_ends)
+
+
+def pending_ranges(db, date_ends, day_ends_at=3) -> List[Tuple]:
+    """
+    Return (start, end) ranges covering every day before date_ends which
+    has events that have not been consumed. Consecutive days are joined
+    into a single range, and days which have been fully consumed are
+    left out altogether.
+    """
     date_ends = date_ends.replace(hour=day_ends_at)
-    logger.info(
-        'Getting events between {} and {}'.format(date_starts, date_ends))
+    days = db.pending_days(date_ends, day_ends_at)
+    ranges = []
+    for day in days:
+        next_day = min(day + timedelta(days=1), date_ends)
+        if ranges and ranges[-1][1] == day:
+            ranges[-1] = (ranges[-1][0], next_day)
+        else:
+            ranges.append((day, next_day))
 
-    return db.get_events(date_starts, date_ends)
+    logger.info('{} days with pending events before {}'.format(
+        len(days), date_ends))
+    for date_starts, range_ends in ranges:
+        logger.info('Getting events between {} and {}'.format(
+            date_starts, range_ends))
+    return ranges
 
 
 def categorise_event(event, definitions) -> str:
@@ -217,9 +961,42 @@ def categorise_event(event, definitions) -> str:
     return None
 
 
-def categorise_events(events, definitions) -> None:
+def categorise_events(events, definitions, cache=None) -> ClassifierCache:
+    '''
+    Classify events in a batch, passing each distinct (process, title)
+    pair through the classifier chain only once. The resulting
+    ClassifierResult is shared by every matching event, so its tags
+    list must not be modified in place.
+    '''
+    if cache is None:
+        cache = ClassifierCache(definitions)
+
+    if isinstance(events, EventBatch):
+        events.categorise(cache)
+        cache.flush()
+        return cache
+
+    for _ in iter_categorise_events(events, cache):
+        pass
+
+    return cache
+
+
+def iter_categorise_events(events, cache) -> Iterator[Event]:
+    '''
+    Streaming version of categorise_events: each event is yielded as soon
+    as it has been classified. Any new results are written to the cache
+    store once the stream is exhausted.
+    '''
     for e in events:
-        categorise_event(e, definitions)
+        result = cache.get(e.process, e.title)
+        if result:
+            e.project = result.project
+            e.description = result.description
+            e.tags = result.tags
+        yield e
+
+    cache.flush()
 
 
 def build_project_dict(events) -> Dict[str, Event]:
@@ -253,48 +1030,109 @@ def compress_events(events, config) -> List[Event]:
           events will be ignored.
     '''
     # Ensure events are in order of occurrence
-    events.sort(key=lambda x: x.start)
+    if isinstance(events, EventBatch):
+        events.sort()
+        if autotoggl.vectorized.available():
+            return _compress_batch_vectorized(events, config)[0]
+    else:
+        events.sort(key=lambda x: x.start)
 
-    # Calculate naive durations by going through the events pairwise
-    for a, b in zip(events[:-1], events[1:]):
-        a.duration = b.start - a.start
+    return list(iter_compress_events(events, config))
 
-    # Calculate complete durations by weeding out short events
-    # and taking system events into account
-    for n, e in enumerate(events):
-        if (e.duration < config.minimum_event_seconds
-                or e.title == EVENT_SYSTEM):
-            e.duration = 0
-            continue
 
-        if not e.project:
-            # Unassigned events should be ignored at this stage
-            continue
+def _compress_batch_vectorized(batch, config,
+                               final=True) -> Tuple[List[Event], int]:
+    '''
+    Equivalent to compress_events for an EventBatch, using NumPy.
+    Event objects are only built for the compressed results.
 
-        for o in events[n+1:]:
-            if o.title == EVENT_SYSTEM:
-                # o.duration = 0
-                break
+    Also returns the index of the first row which rows following the
+    batch could still change. Unless `final`, an event still open at the
+    end of the batch is left out, so that it can be compressed again
+    along with the rows that follow.
+    '''
+    openers, durations, closes = autotoggl.vectorized.compress(
+        batch.starts,
+        batch.durations[-1] if len(batch) else 0,
+        batch.titles,
+        (r is not None and bool(r.project) for r in batch.results),
+        EVENT_SYSTEM,
+        config.minimum_event_seconds)
+
+    if len(openers) and closes[-1] == len(batch):
+        # The last event is still open
+        restart = int(openers[-1])
+        if not final:
+            openers, durations, closes = (
+                openers[:-1], durations[:-1], closes[:-1])
+    elif len(openers):
+        # Closed by a system event, or by an event with no duration yet
+        restart = int(closes[-1])
+    else:
+        # Nothing before the last system event can be changed
+        restart = next(
+            (n for n in range(len(batch) - 1, -1, -1)
+             if batch.titles[n] == EVENT_SYSTEM), 0)
+
+    events = []
+    for n, duration, close in zip(
+            openers.tolist(), durations.tolist(), closes.tolist()):
+        e = batch[n]
+        e.duration = duration
+        e.merged.extend(batch.ids[n + 1:close])
+        events.append(e)
+    return events, restart
+
+
+def iter_compress_events(events, config) -> Iterator[Event]:
+    '''
+    Streaming version of compress_events. `events` must already be in
+    order of occurrence.
 
-            if o.duration < config.minimum_event_seconds:
-                e.merge(o)
+    Each compressed event is yielded as soon as a following event closes
+    it, so only the ongoing event and the next one need to be held.
+    '''
+    minimum = config.minimum_event_seconds
+
+    # The event currently absorbing any following events, if any
+    ongoing = None
+
+    events = iter(events)
+    e = next(events, None)
+    while e is not None:
+        following = next(events, None)
+        if following is not None:
+            # Naive duration, until the next event starts
+            e.duration = following.start - e.start
+
+        if ongoing is not None:
+            if e.title != EVENT_SYSTEM and (
+                    e.duration < minimum
+                    or e.title == ongoing.title
+                    or not e.project):
+                # Short events, consecutive events with the same name and
+                # unassigned events are all squashed into the ongoing event
+                ongoing.merge(e)
+                e = following
+                continue
 
-            elif e.title == o.title:
-                # If consecutive events have the same name then
-                # squash them into the first occurrence
-                e.merge(o)
+            # A system event, or another event long enough to take over
+            if ongoing.duration:
+                yield ongoing
+            ongoing = None
 
-            elif not o.project:
-                # Merge unassigned events into the ongoing event
-                e.merge(o)
+        if e.duration < minimum or e.title == EVENT_SYSTEM:
+            e.duration = 0
 
-            else:
-                # Another event long enough to take over
-                break
+        elif e.project:
+            ongoing = e
 
-    # Remove any event with 0 duration
-    # or no project assignment
-    return list(filter(lambda x: x.duration and x.project, events))
+        # Unassigned events are ignored if nothing is ongoing
+
+        e = following
+
+    if ongoing is not None and ongoing.duration:
+        yield ongoing
 
 
 def get_total_duration(events) -> int:
@@ -309,11 +1147,25 @@ def print_events(events, starts, ends) -> None:
         logger.info(e)
 
 
-def submit(interface, projects) -> Tuple[List[int], List[int]]:
-    interface.get_all_projects()
-    successful = []
-    failed = []
-    for p, events in projects.items():
+def submit(interface, projects, concurrency=1,
+           on_complete=None) -> Tuple[List[Event], List[Event]]:
+    '''
+    Create any missing projects, then post a time entry for every event
+    that has not been consumed.
+
+    Up to `concurrency` entries are submitted at once. All requests share
+    the rate limiter of the interface, so this only overlaps the latency
+    of each request.
+
+    If given, on_complete(event, error) is called from the calling thread
+    as soon as each request completes. error is None if it succeeded.
+    '''
+    interface.ensure_projects()
+    for p in projects:
+        if p not in interface.projects and not interface.refreshed:
+            # The project may have been added since the cache was saved
+            interface.refresh_projects()
+
         if p not in interface.projects:
             logger.debug('Creating project \'{}\''.format(p))
             try:
@@ -321,27 +1173,85 @@ def submit(interface, projects) -> Tuple[List[int], List[int]]:
             except ApiError as e:
                 logger.warning(e)
 
-        for e in events:
-            if e.consumed:
-                continue
+    pending = [
+        e for events in projects.values() for e in events if not e.consumed]
 
-            try:
-                interface.create_time_entry(
-                    e.project,
-                    e.description,
-                    e.start,
-                    e.duration,
-                    tags=e.tags)
-                e.consumed = True
-                successful.append(e)
-            except ApiError as err:
-                failed.append(e)
-                logger.warning(err)
-            time.sleep(1)
+    successful = []
+    failed = []
+    for e, err in _submit_entries(interface, pending, concurrency):
+        if err is None:
+            e.consumed = True
+            successful.append(e)
+        else:
+            failed.append(e)
+            logger.warning(err)
+
+        if on_complete:
+            on_complete(e, err)
 
     return successful, failed
 
 
+def _submit_entries(interface, events,
+                    concurrency) -> Iterator[Tuple[Event, ApiError]]:
+    '''
+    Yield each event together with the error raised when submitting it,
+    or None if it was successful, as soon as its request completes.
+    '''
+    if concurrency <= 1:
+        for e in events:
+            yield e, _submit_entry(interface, e)
+        return
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {
+            pool.submit(_submit_entry, interface, e): e for e in events}
+        completed = set()
+        try:
+            for future in as_completed(futures):
+                completed.add(future)
+                yield futures[future], future.result()
+        except GeneratorExit:
+            # The caller has stopped listening, so nothing more is posted
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        except BaseException:
+            # An unexpected error, e.g. KeyboardInterrupt. Entries which
+            # have not started are cancelled, and the results of those
+            # already running are still reported so that every entry
+            # posted to Toggl can be recorded.
+            pool.shutdown(wait=False, cancel_futures=True)
+            yield from _drain(futures, completed)
+            raise
+
+
+def _drain(futures, completed) -> Iterator[Tuple[Event, ApiError]]:
+    '''
+    Wait for requests which were already running when submission was
+    stopped, and yield the results of any that completed cleanly.
+    '''
+    for future, e in futures.items():
+        if future in completed or future.cancelled():
+            continue
+        try:
+            err = future.result()
+        except BaseException:
+            continue
+        yield e, err
+
+
+def _submit_entry(interface, e) -> Exception:
+    try:
+        interface.create_time_entry(
+            e.project,
+            e.description,
+            e.start,
+            e.duration,
+            tags=e.tags)
+    except (ApiError, requests.RequestException) as err:
+        return err
+
+
 def _send_notification(content, successful=None, failed=None):
     try:
         from bmanotify import EventNotifier
@@ -365,86 +1275,319 @@ def _send_notification(content, successful=None, failed=None):
         logger.warning(f'Error sending notification: {e}')
 
 
+def _compress_range(db, date_starts, date_ends, cache, config,
+                    metrics) -> List[Event]:
+    '''
+    Read, classify and compress the events in a range with NumPy, one
+    day at a time. Rows which the following day could still change,
+    such as those of an event still open at the end of a day, are
+    carried into the next day's EventBatch, so the results are the same
+    as for the whole range at once.
+    '''
+    events = []
+    batch = EventBatch()
+    day_starts = date_starts
+    while day_starts < date_ends:
+        day_ends = min(day_starts + timedelta(days=1), date_ends)
+        final = day_ends >= date_ends
+        carried = len(batch)
+
+        # Ranges include their end, so stop a second short of the next
+        # day to read an event on the boundary only once
+        read_until = day_ends if final else day_ends - timedelta(seconds=1)
+        with metrics.stage('get_events') as stage:
+            batch = db.get_event_batch(day_starts, read_until, batch)
+            stage.items_out = (stage.items_out or 0) + len(batch) - carried
+
+        with metrics.stage(
+                'categorise_events', items_in=len(batch)) as stage:
+            categorise_events(batch, config.classifiers, cache)
+            stage.items_out = (stage.items_out or 0) + len(batch)
+
+        with metrics.stage('compress_events', items_in=len(batch)) as stage:
+            batch.sort()
+            compressed, restart = _compress_batch_vectorized(
+                batch, config, final)
+            stage.items_out = (stage.items_out or 0) + len(compressed)
+
+        events.extend(compressed)
+        batch = batch.tail(restart)
+        day_starts = day_ends
+
+    return events
+
+
+def _outbox(db, config) -> Outbox:
+    return Outbox(
+        db,
+        retry_seconds=config.outbox_retry_seconds,
+        max_attempts=config.outbox_max_attempts)
+
+
+def resume(db, config, metrics=None) -> None:
+    '''
+    Submit any entries left in the outbox by an interrupted or failed
+    run, without recomputing the days they came from.
+    '''
+    metrics = metrics or Metrics()
+    outbox = _outbox(db, config)
+    events = outbox.due()
+    if not events:
+        logger.info('No entries are due for submission: {}'.format(
+            outbox.counts()))
+        return
+
+    logger.info('Resuming {} entries'.format(len(events)))
+    if config.local:
+        print_events(events, config.day_starts, config.day_ends)
+        return
+
+    api = TogglApiInterface(
+        config, cache_file=PROJECTS_CACHE_FILE, metrics=metrics)
+    with metrics.stage('submit', items_in=len(events)) as stage:
+        successful, failed = submit(
+            api, build_project_dict(events),
+            concurrency=config.submit_concurrency,
+            on_complete=outbox.record)
+        stage.items_out = len(successful)
+    metrics.count('entries_submitted', len(successful))
+    metrics.count('entries_failed', len(failed))
+
+    if failed:
+        logger.warning(
+            '{} events failed to be submitted'.format(len(failed)))
+
+
 def main() -> None:
-    with DatabaseManager() as db:
+    metrics = Metrics()
+    with metrics.stage('load_config'):
         config = load_config()
 
-        if config.config:
-            os.startfile(os.path.normpath(CONFIG_FILE))
-            return
+    with metrics.stage('open_database'):
+        db = DatabaseManager(
+            profile=ConnectionProfile.from_config(config),
+            normalize=config.normalized_storage)
 
-        if config.clean:
-            db.clean_up(**config.clean)
-            return
+    with db:
+        if config.query_sample_rate or config.slow_query_seconds is not None:
+            db.tracer = QueryTracer(
+                sample_rate=config.query_sample_rate,
+                slow_seconds=config.slow_query_seconds)
 
-        if config.reset:
-            db.reset(config.day_starts, config.day_ends)
-            logger.info(
-                'All entries between {} and {} have been reset'
-                .format(
-                    config.day_starts.isoformat(),
-                    config.day_ends.isoformat()))
-            return
+        profiler = None
+        if config.profile:
+            profiler = Profiler(config.profile, os.path.dirname(DB_PATH))
+            metrics.on_stage_end = profiler.snapshot
+            profiler.start()
 
-        if config.catchup:
-            events = get_events_until(db, config.date, config.day_ends_at)
-        else:
-            events = get_events_for_date(db, config.date, config.day_ends_at)
+        try:
+            run(db, config, metrics)
+        finally:
+            if profiler:
+                for filename in profiler.stop():
+                    logger.info('Profile saved to {}'.format(filename))
+            if db.tracer:
+                logger.info(db.tracer.summary())
+                metrics.count('db_statements', sum(
+                    s.calls for s in db.tracer.statements.values()))
+                metrics.count('db_seconds', sum(
+                    s.seconds for s in db.tracer.statements.values()))
+            logger.info(metrics)
+            if config.metrics_file:
+                metrics.write(config.metrics_file)
+
+
+def run(db, config, metrics) -> None:
+    if config.config:
+        os.startfile(os.path.normpath(CONFIG_FILE))
+        return
 
-        categorise_events(
-            events, config.classifiers)
-        events = compress_events(events, config)
-        projects = build_project_dict(events)
+    if config.clean:
+        with metrics.stage('clean_up'):
+            db.clean_up(**config.clean)
+        return
 
-        if config.showall:
-            print_events(
-                events, config.day_starts, config.day_ends)
+    if config.reset:
+        db.reset(config.day_starts, config.day_ends)
+        logger.info(
+            'All entries between {} and {} have been reset'
+            .format(
+                config.day_starts.isoformat(),
+                config.day_ends.isoformat()))
+        return
 
-        if not events:
-            logger.info('No events!')
-            raise SystemExit()
+    if config.resume:
+        resume(db, config, metrics)
+        return
 
-        if config.render:
-            logger.info('Building preview HTML...')
+    cache = ClassifierCache(
+        config.classifiers,
+        maxsize=config.classifier_cache_size,
+        store=ClassificationStore(db, config.classifier_hash))
+
+    # Catching up only reads days with pending events. Each range of
+    # them is compressed separately, so that no event lasts across the
+    # consumed days in between.
+    events = []
+    if config.catchup:
+        ranges = pending_ranges(db, config.date, config.day_ends_at)
+        if autotoggl.vectorized.available():
+            # Ranges are read into an EventBatch so that they can be
+            # compressed with NumPy
+            for date_starts, date_ends in ranges:
+                events.extend(_compress_range(
+                    db, date_starts, date_ends, cache, config, metrics))
+            streams = []
+        else:
+            streams = [
+                db.iter_events(date_starts, date_ends)
+                for date_starts, date_ends in ranges]
+    else:
+        ranges = [day_range(config.date, config.day_ends_at)]
+        streams = [
+            iter_events_for_date(db, config.date, config.day_ends_at)]
+
+    # Otherwise events are streamed from the database through
+    # classification and compression, so only the compressed results
+    # are kept
+    for stream in streams:
+        stream = metrics.iterate('get_events', stream)
+        stream = metrics.iterate(
+            'categorise_events', iter_categorise_events(stream, cache),
+            source='get_events')
+        events.extend(metrics.iterate(
+            'compress_events', iter_compress_events(stream, config),
+            source='categorise_events'))
+    logger.info(cache)
+    metrics.count('classifier_cache_hits', cache.hits)
+    metrics.count('classifier_cache_misses', cache.misses)
+
+    with metrics.stage('build_project_dict', items_in=len(events)) as stage:
+        projects = build_project_dict(events)
+        stage.items_out = len(projects)
+
+    n_consumed_events = {}
+    for p in projects:
+        n_total_events = len(projects[p])
+        projects[p] = [e for e in projects[p] if not e.consumed]
+        n_consumed_events[p] = n_total_events - len(projects[p])
+
+    # Entries are planned before anything is shown, so that -showall and
+    # -render preview exactly what will be submitted
+    if config.merge_tolerance_seconds > 0:
+        unplanned = [e for x in projects.values() for e in x]
+        with metrics.stage('plan_entries') as stage:
+            stage.items_in = len(unplanned)
+            projects, saved = plan_entries(
+                projects, config.merge_tolerance_seconds)
+            stage.items_out = sum(len(x) for x in projects.values())
+        logger.info(
+            'Merged entries within {}s of each other, '
+            'saving {} API calls'
+            .format(config.merge_tolerance_seconds, saved))
+
+        # Entries absorbed into another are no longer shown separately
+        planned = set(id(e) for x in projects.values() for e in x)
+        absorbed = set(id(e) for e in unplanned if id(e) not in planned)
+        events = [e for e in events if id(e) not in absorbed]
+
+    if config.showall:
+        print_events(
+            events, config.day_starts, config.day_ends)
+
+    if not events:
+        logger.info('No events!')
+        _close_ranges(db, config, ranges)
+        raise SystemExit()
+
+    if config.render:
+        logger.info('Building preview HTML...')
+        with metrics.stage('render_events', items_in=len(events)):
             autotoggl.render.render_events(events)
 
-        pending_submission = 0
-        notification_content = []
-        for p in projects:
-            n_total_events = len(projects[p])
-            projects[p] = [e for e in projects[p] if not e.consumed]
-            n_pending_events = len(projects[p])
-            notification_content.append(
-                '{project}: [{duration}] {pending} events'
-                .format(
-                    project=p,
-                    duration=timedelta(
-                        seconds=get_total_duration(projects[p])),
-                    pending=n_pending_events))
+    pending_submission = 0
+    notification_content = []
+    for p in projects:
+        n_pending_events = len(projects[p])
+        notification_content.append(
+            '{project}: [{duration}] {pending} events'
+            .format(
+                project=p,
+                duration=timedelta(
+                    seconds=get_total_duration(projects[p])),
+                pending=n_pending_events))
+        logger.info(
+            'Project \'{project}\': [{duration}] {pending} events '
+            '({consumed} already consumed)'
+            .format(
+                project=p,
+                duration=timedelta(seconds=get_total_duration(projects[p])),
+                pending=n_pending_events,
+                consumed=n_consumed_events[p]))
+        pending_submission += n_pending_events
+
+    if pending_submission == 0:
+        _close_ranges(db, config, ranges)
+
+    if pending_submission > 0 and not config.local:
+        # Record every planned entry before making any requests, then
+        # commit the result of each request as soon as it completes
+        api = TogglApiInterface(
+            config, cache_file=PROJECTS_CACHE_FILE, metrics=metrics)
+
+        if config.reconcile:
+            # Skip any entries which already exist in Toggl
+            with metrics.stage('reconcile') as stage:
+                stage.items_in = pending_submission
+                api.ensure_projects()
+                projects, matched = reconcile(api, projects)
+                for e in matched:
+                    e.consumed = True
+                db.consume(matched)
+                stage.items_out = sum(len(x) for x in projects.values())
             logger.info(
-                'Project \'{project}\': [{duration}] {pending} events '
-                '({consumed} already consumed)'
-                .format(
-                    project=p,
-                    duration=timedelta(seconds=get_total_duration(projects[p])),
-                    pending=n_pending_events,
-                    consumed=n_total_events - n_pending_events))
-            pending_submission += n_pending_events
-
-        if pending_submission > 0 and not config.local:
-            api = TogglApiInterface(config)
-            successful, failed = submit(api, projects)
-
-            _send_notification(
-                notification_content,
-                successful=successful,
-                failed=failed)
-
-            db.consume(successful)
-
-            if failed:
-                logger.warning(
-                    '{} events failed to be submitted'.format(len(failed)))
+                '{} entries already exist in Toggl'.format(len(matched)))
+
+        outbox = _outbox(db, config)
+        outbox.plan(e for p in projects for e in projects[p])
+
+        with metrics.stage('submit') as stage:
+            stage.items_in = sum(len(x) for x in projects.values())
+            successful, failed = submit(
+                api, projects,
+                concurrency=config.submit_concurrency,
+                on_complete=outbox.record)
+            stage.items_out = len(successful)
+        metrics.count('entries_submitted', len(successful))
+        metrics.count('entries_failed', len(failed))
+
+        _send_notification(
+            notification_content,
+            successful=successful,
+            failed=failed)
+
+        if failed:
+            logger.warning(
+                '{} events failed to be submitted'.format(len(failed)))
+        else:
+            _close_ranges(db, config, ranges)
+
+
+def _close_ranges(db, config, ranges) -> None:
+    '''
+    Consume the remaining events of each range once everything in it
+    has been submitted, so that catch-up no longer sees it as pending.
+    A range which has not ended yet is left alone, as its last events
+    may still become part of an entry.
+    '''
+    if config.local:
+        return
+    now = datetime.datetime.now()
+    for date_starts, date_ends in ranges:
+        if date_ends <= now:
+            n = db.consume_range(date_starts, date_ends)
+            logger.debug('Closed {} -> {}: {} events'.format(
+                date_starts, date_ends, n))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,170 @@
+import json
+
+from collections import OrderedDict
+from typing import Optional
+
+from autotoggl.config import ClassifierResult
+
+
+# Marks a key that has not been seen, as distinct from a cached None
+# result for a window that no classifier recognises
+_MISSING = object()
+
+
+class ClassifierCache:
+    '''
+    Bounded memo of classifier results keyed on (process, window_title).
+
+    A day of events typically repeats a few hundred window titles many
+    thousands of times, so each distinct pair only needs to go through
+    the classifier chain once. When the memo is full the least recently
+    used entry is evicted.
+    '''
+
+    def __init__(self, definitions, maxsize=4096, store=None):
+        self.definitions = definitions
+        self.maxsize = maxsize
+
+        # Optional ClassificationStore which is checked before doing
+        # any classification work for a key that is not in memory
+        self.store = store
+
+        self.hits = 0
+        self.misses = 0
+        self.store_hits = 0
+
+        self._results = OrderedDict()
+
+    def __len__(self):
+        return len(self._results)
+
+    def __repr__(self):
+        return (
+            'ClassifierCache: {hits} hits, {misses} misses '
+            '({store_hits} from store), {size}/{maxsize}'
+            .format(
+                hits=self.hits,
+                misses=self.misses,
+                store_hits=self.store_hits,
+                size=len(self._results),
+                maxsize=self.maxsize))
+
+    def get(self, process, window_title) -> Optional[ClassifierResult]:
+        key = (process, window_title)
+        result = self._results.get(key, _MISSING)
+        if result is not _MISSING:
+            self.hits += 1
+            self._results.move_to_end(key)
+            return result
+
+        self.misses += 1
+        if self.store:
+            result = self.store.get(process, window_title)
+            if result is not _MISSING:
+                self.store_hits += 1
+                self._put(key, result)
+                return result
+
+        result = self._classify(process, window_title)
+        self._put(key, result)
+        if self.store:
+            self.store.put(process, window_title, result)
+        return result
+
+    def flush(self) -> None:
+        if self.store:
+            self.store.flush()
+
+    def _classify(self, process, window_title) -> Optional[ClassifierResult]:
+        classifier = self.definitions.get(process)
+        if classifier:
+            return classifier.get(window_title)
+
+    def _put(self, key, result) -> None:
+        self._results[key] = result
+        if len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+
+
+class ClassificationStore:
+    '''
+    Classifier results persisted in a side table of toggl.db, so that
+    catch-up runs do not have to reclassify the same window titles every
+    time. Rows are keyed by a hash of the project definitions and any rows
+    saved under a different hash are removed when the store is opened.
+    '''
+
+    def __init__(self, db, config_hash):
+        self.db = db
+        self.config_hash = config_hash
+
+        # Results waiting to be written by flush()
+        self._pending = []
+
+        self.db.exec(
+            '''CREATE TABLE IF NOT EXISTS classifier_cache
+               (config_hash TEXT NOT NULL,
+               process_name TEXT NOT NULL,
+               window_title TEXT NOT NULL,
+               project TEXT,
+               description TEXT,
+               tags TEXT,
+               PRIMARY KEY (config_hash, process_name, window_title))
+               WITHOUT ROWID''')
+        self._invalidate()
+
+    def _invalidate(self) -> None:
+        '''
+        Remove results from any previous project definitions. Written as a
+        pair of ranges rather than <> so that the primary key can be used.
+
+        The delete is committed straight away, and only made at all if
+        there are stale rows, so that the store never holds the write lock
+        while events are being read.
+        '''
+        stale = self.db.exec(
+            '''SELECT 1 FROM classifier_cache
+               WHERE config_hash<? OR config_hash>? LIMIT 1''',
+            (self.config_hash, self.config_hash)).fetchone()
+        if stale is None:
+            return
+        with self.db.conn:
+            self.db.exec(
+                '''DELETE FROM classifier_cache
+                   WHERE config_hash<? OR config_hash>?''',
+                (self.config_hash, self.config_hash))
+
+    def get(self, process, window_title):
+        '''
+        Return the stored ClassifierResult, None for a window that was
+        stored as unrecognised, or _MISSING if it has not been seen.
+        '''
+        r = self.db.exec(
+            '''SELECT project, description, tags FROM classifier_cache
+               WHERE config_hash=? AND process_name=? AND window_title=?''',
+            (self.config_hash, process, window_title)).fetchone()
+        if r is None:
+            return _MISSING
+        if r[0] is None:
+            return None
+        return ClassifierResult(
+            project=r[0], description=r[1], tags=json.loads(r[2]))
+
+    def put(self, process, window_title, result) -> None:
+        if result:
+            row = (
+                self.config_hash, process, window_title,
+                result.project, result.description, json.dumps(result.tags))
+        else:
+            row = (self.config_hash, process, window_title, None, None, None)
+        self._pending.append(row)
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        with self.db.conn:
+            self.db.exec_many(
+                '''INSERT OR REPLACE INTO classifier_cache
+                   VALUES (?, ?, ?, ?, ?, ?)''',
+                self._pending)
+        self._pending = []
@@ -0,0 +1,392 @@
+'''
+Long-running process which receives window focus events and writes them
+to toggl.db in batches.
+
+Clients connect to a TCP socket on localhost and send one JSON object
+per line:
+    {"process": "chrome", "title": "Google", "start": 1528794000}
+
+`start` is optional and defaults to the time the event was received.
+Events are buffered and written in a single transaction when
+flush_size events are waiting, or when flush_seconds have passed, so at
+most flush_seconds of events can be lost if the collector is killed.
+
+If retention_days is configured, consumed events older than that are
+also deleted by the collector, a slice at a time between flushes.
+
+Usage:
+    autotoggl-collector [--port 47311] [--flush_size 100]
+        [--flush_seconds 5]
+'''
+import datetime
+import json
+import logging
+import signal
+import socket
+import socketserver
+import threading
+import time
+
+from argparse import ArgumentParser
+from typing import List, Optional
+
+import autotoggl.autotoggl as autotoggl
+
+from autotoggl.config import Config, ConfigError, InvalidConfig
+from autotoggl.util import midnight
+
+
+DEFAULT_PORT = 47311
+
+
+def _init_logger(name=__file__, level=logging.INFO):
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    logger.addHandler(logging.StreamHandler())
+    return logger
+
+
+logger = _init_logger()
+
+
+def send(process, title, start=None, host='127.0.0.1', port=DEFAULT_PORT,
+         timeout=1.0) -> None:
+    '''
+    Send a single event to a running collector. Raises OSError if the
+    collector is not running, so that the caller can fall back to
+    writing to the database itself.
+    '''
+    event = {'process': process, 'title': title}
+    if start is not None:
+        event['start'] = start
+    with socket.create_connection((host, port), timeout=timeout) as s:
+        s.sendall((json.dumps(event) + '\n').encode('utf-8'))
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line.decode('utf-8'))
+                row = (
+                    str(event['process']),
+                    str(event['title']),
+                    int(event.get('start') or time.time()),
+                    False,
+                )
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning('Ignoring invalid event {}: {}'.format(
+                    line[:200], e))
+                continue
+            self.server.collector.add(row)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # Focus changes come in bursts when switching quickly between windows
+    request_queue_size = 64
+
+
+class RetentionSchedule:
+    '''
+    Delete consumed events that are more than `days` old, in slices.
+
+    Each slice either deletes up to chunk_size events or returns up to
+    vacuum_pages free pages to the filesystem, in its own short
+    transaction. Once there is nothing left to do, nothing more is done
+    for interval_seconds.
+    '''
+
+    def __init__(self, days, chunk_size=500, vacuum_pages=100,
+                 interval_seconds=3600, clock=time.time):
+        self.days = days
+        self.chunk_size = chunk_size
+        self.vacuum_pages = vacuum_pages
+        self.interval_seconds = interval_seconds
+        self._clock = clock
+        self._next_run = 0.0
+
+        self.deleted = 0
+        self.freed = 0
+
+    @classmethod
+    def from_config(cls, config) -> Optional['RetentionSchedule']:
+        if not config or config.retention_days is None:
+            return None
+        return cls(
+            config.retention_days,
+            chunk_size=config.retention_chunk_size,
+            vacuum_pages=config.retention_vacuum_pages,
+            interval_seconds=config.retention_interval_seconds)
+
+    def run_slice(self, db) -> bool:
+        '''
+        Do one slice of work, if any is due.
+        Returns True if there is more to do straight away.
+        '''
+        now = self._clock()
+        if now < self._next_run:
+            return False
+
+        before = midnight(
+            datetime.datetime.fromtimestamp(now)
+            - datetime.timedelta(days=self.days))
+        deleted = db.delete_events_before(before, limit=self.chunk_size)
+        self.deleted += deleted
+        if deleted >= self.chunk_size:
+            return True
+
+        freed = db.incremental_vacuum(self.vacuum_pages)
+        self.freed += freed
+        if freed >= self.vacuum_pages:
+            return True
+
+        logger.info('Retention: deleted {} events, freed {} pages'.format(
+            self.deleted, self.freed))
+        self._next_run = now + self.interval_seconds
+        return False
+
+
+class Collector:
+    '''
+    Buffer events from clients and write them to the database in
+    batched transactions from a single writer thread.
+
+    If a write fails, e.g. because the database is locked by another
+    process for longer than its timeout, the batch is kept and retried
+    at the next flush. No more than max_buffer events are held; beyond
+    that the oldest are dropped.
+
+    An optional RetentionSchedule is run by the same thread, one slice
+    at a time, so buffered events are still written between slices.
+    '''
+
+    def __init__(self, filename=autotoggl.DB_PATH, host='127.0.0.1',
+                 port=DEFAULT_PORT, flush_size=100, flush_seconds=5.0,
+                 max_buffer=100000, profile=None, retention=None,
+                 normalize=False):
+        self.filename = filename
+        self.profile = profile
+        self.normalize = normalize
+        self.retention = retention
+        self.flush_size = flush_size
+        self.flush_seconds = flush_seconds
+        self.max_buffer = max_buffer
+
+        self.server = _Server((host, port), _Handler)
+        self.server.collector = self
+
+        # Counters for inspecting how the collector behaved
+        self.received = 0
+        self.written = 0
+        self.flushes = 0
+        self.failed_writes = 0
+        self.dropped = 0
+
+        self._buffer: List[tuple] = []
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._writer: Optional[threading.Thread] = None
+        self._writer_ready = threading.Event()
+        self._writer_error: Optional[BaseException] = None
+        self._server_thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, ctx_type, ctx_value, ctx_traceback):
+        self.stop()
+
+    def add(self, row) -> None:
+        with self._condition:
+            self._buffer.append(row)
+            self.received += 1
+            if len(self._buffer) > self.max_buffer:
+                del self._buffer[0]
+                self.dropped += 1
+            if len(self._buffer) >= self.flush_size:
+                self._condition.notify()
+
+    def start(self) -> None:
+        '''
+        Start accepting events and writing them in the background.
+        Raises the error if the database cannot be opened.
+        '''
+        self._start_writer()
+        self._server_thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self._server_thread.start()
+
+    def serve_forever(self) -> None:
+        '''
+        Run until stop() is called, e.g. from a signal handler.
+        Raises the error if the database cannot be opened.
+        '''
+        self._start_writer()
+        try:
+            self.server.serve_forever()
+        finally:
+            self._stop_writer()
+            self.server.server_close()
+
+    def stop(self) -> None:
+        '''Stop accepting events and write any that are buffered'''
+        self.server.shutdown()
+        if self._server_thread is not None:
+            self._server_thread.join()
+            self._server_thread = None
+            self._stop_writer()
+            self.server.server_close()
+
+    def _start_writer(self) -> None:
+        # Wait for the database to be created or migrated before
+        # accepting events, so that clients are not kept waiting
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+        self._writer_ready.wait()
+
+        # Events must not be accepted if they can never be written
+        if self._writer_error is not None:
+            self._writer.join()
+            self._writer = None
+            self.server.server_close()
+            raise self._writer_error
+
+    def _stop_writer(self) -> None:
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._writer.join()
+
+    def _write_loop(self) -> None:
+        # The connection is opened here because sqlite3 connections can
+        # only be used by the thread that created them
+        try:
+            db = autotoggl.DatabaseManager(
+                filename=self.filename, profile=self.profile,
+                normalize=self.normalize)
+        except BaseException as e:
+            logger.error('Unable to open {}: {}'.format(self.filename, e))
+            self._writer_error = e
+            return
+        finally:
+            self._writer_ready.set()
+
+        with db:
+            more_retention = False
+            while True:
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: (self._stopping
+                                 or len(self._buffer) >= self.flush_size),
+                        timeout=0 if more_retention else self.flush_seconds)
+                    rows, self._buffer = self._buffer, []
+                    stopping = self._stopping
+
+                if rows and not self._write(db, rows):
+                    if stopping:
+                        logger.error(
+                            '{} events were not written'.format(len(rows)))
+                    else:
+                        self._requeue(rows)
+
+                if stopping:
+                    return
+
+                if self.retention is not None:
+                    more_retention = self._run_retention(db)
+
+    def _run_retention(self, db) -> bool:
+        try:
+            return self.retention.run_slice(db)
+        except Exception as e:
+            logger.warning('Retention failed, will retry: {}'.format(e))
+            return False
+
+    def _requeue(self, rows) -> None:
+        with self._condition:
+            self._buffer[:0] = rows
+            overflow = len(self._buffer) - self.max_buffer
+            if overflow > 0:
+                del self._buffer[:overflow]
+                self.dropped += overflow
+
+    def _write(self, db, rows) -> bool:
+        try:
+            db.insert_events(rows)
+        except Exception as e:
+            self.failed_writes += 1
+            logger.warning(
+                'Unable to write {} events, will retry: {}'.format(
+                    len(rows), e))
+            return False
+        self.written += len(rows)
+        self.flushes += 1
+        return True
+
+
+def _load_config() -> Optional[Config]:
+    try:
+        return Config(autotoggl.CONFIG_FILE, clargs={})
+    except (ConfigError, InvalidConfig) as e:
+        logger.warning('Using default settings: {}'.format(e))
+        return None
+
+
+def main():
+    config = _load_config()
+
+    parser = ArgumentParser()
+    parser.add_argument('--db', default=autotoggl.DB_PATH)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument(
+        '--port', type=int,
+        default=config.collector_port if config else DEFAULT_PORT)
+    parser.add_argument(
+        '--flush_size', type=int,
+        default=config.collector_flush_size if config else 100,
+        help='Write buffered events once this many are waiting')
+    parser.add_argument(
+        '--flush_seconds', type=float,
+        default=config.collector_flush_seconds if config else 5.0,
+        help='Write buffered events at least this often. This is the '
+             'most that can be lost if the collector is killed.')
+    args = parser.parse_args()
+
+    collector = Collector(
+        args.db, args.host, args.port,
+        flush_size=args.flush_size,
+        flush_seconds=args.flush_seconds,
+        profile=autotoggl.ConnectionProfile.from_config(config)
+        if config else None,
+        retention=RetentionSchedule.from_config(config),
+        normalize=config.normalized_storage if config else False)
+
+    def _terminate(signum, frame):
+        # shutdown() waits for serve_forever to return, so it must be
+        # called from another thread
+        threading.Thread(target=collector.server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, _terminate)
+
+    logger.info('Collecting events on {}:{}'.format(args.host, collector.port))
+    try:
+        collector.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    logger.info('Wrote {} events in {} transactions'.format(
+        collector.written, collector.flushes))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import os
 import re
@@ -6,8 +7,13 @@ from argparse import ArgumentParser
 from datetime import datetime, timedelta
 from typing import Optional
 
+from autotoggl.profiling import PROFILE_ALL, PROFILE_MODES
 from autotoggl.util import midnight
 
+# Values accepted by PRAGMA journal_mode and PRAGMA synchronous
+JOURNAL_MODES = ["delete", "truncate", "persist", "memory", "wal", "off"]
+SYNCHRONOUS = ["off", "normal", "full", "extra"]
+
 
 class InvalidConfig(Exception):
     """
@@ -30,11 +36,38 @@ class Config:
         self.filepath = file
 
         self.api_key: Optional[str] = None
+        self.api_base: Optional[str] = None
         self.default_workspace = None
         self.classifiers: dict = {}
+        self.classifier_hash: Optional[str] = None
         self.default_day: str = "today"
         self.minimum_event_seconds: int = 60
         self.day_ends_at: int = 3
+        self.classifier_cache_size: int = 4096
+        self.api_requests_per_second: float = 1.0
+        self.api_burst: int = 1
+        self.submit_concurrency: int = 4
+        self.outbox_retry_seconds: int = 60
+        self.outbox_max_attempts: int = 8
+        self.project_cache_ttl: int = 86400
+        self.merge_tolerance_seconds: int = 0
+        self.metrics_file: Optional[str] = None
+        self.profile: Optional[str] = None
+        self.query_sample_rate: float = 0.0
+        self.collector_port: int = 47311
+        self.collector_flush_size: int = 100
+        self.collector_flush_seconds: float = 5.0
+        self.db_journal_mode: str = "wal"
+        self.db_synchronous: str = "normal"
+        self.db_mmap_bytes: int = 256 * 1024 * 1024
+        self.db_cache_kib: int = 16 * 1024
+        self.db_busy_timeout_seconds: float = 5.0
+        self.retention_days: Optional[int] = None
+        self.retention_chunk_size: int = 500
+        self.retention_vacuum_pages: int = 100
+        self.retention_interval_seconds: int = 3600
+        self.normalized_storage: bool = False
+        self.slow_query_seconds: Optional[float] = None
         self.date = None
         self.local: bool = False
         self.render: bool = False
@@ -43,6 +76,8 @@ class Config:
         self.clean: bool = False
         self.config: bool = False
         self.catchup: bool = False
+        self.resume: bool = False
+        self.reconcile: bool = False
 
         if file:
             self._load_from_file(file)
@@ -78,9 +113,14 @@ class Config:
             defs[x["process"]] = ProcessClassifier(x)
 
         self.classifiers = defs
+        self.classifier_hash = _hash_definitions(
+            config.get("project_definitions", []))
 
         self.api_key = config.get("api_key")
 
+        # Base URL of the Toggl API, if not the default
+        self.api_base = config.get("api_base")
+
         # Name or numeric workspace ID
         self.default_workspace = config.get("default_workspace")
 
@@ -96,6 +136,80 @@ class Config:
         # Useful if you tend to stay up into the wee hours
         self.day_ends_at = config.get("day_ends_at", 3)
 
+        # Maximum number of distinct (process, window title) pairs to
+        # remember classifier results for during a single run
+        self.classifier_cache_size = config.get("classifier_cache_size", 4096)
+
+        # Sustained rate and burst size allowed by the Toggl API.
+        # Requests are throttled to stay within these limits.
+        self.api_requests_per_second = config.get("api_requests_per_second", 1.0)
+        self.api_burst = config.get("api_burst", 1)
+
+        # Maximum number of time entries that are submitted at once
+        self.submit_concurrency = config.get("submit_concurrency", 4)
+
+        # Failed submissions are retried by -resume after an exponential
+        # backoff starting at outbox_retry_seconds, and abandoned after
+        # outbox_max_attempts
+        self.outbox_retry_seconds = config.get("outbox_retry_seconds", 60)
+        self.outbox_max_attempts = config.get("outbox_max_attempts", 8)
+
+        # How long, in seconds, workspaces and projects fetched from Toggl
+        # are reused before they are fetched again
+        self.project_cache_ttl = config.get("project_cache_ttl", 86400)
+
+        # Entries of the same project and description that are separated
+        # by no more than this many seconds are submitted as one entry.
+        # 0 disables merging.
+        self.merge_tolerance_seconds = config.get("merge_tolerance_seconds", 0)
+
+        # Stage timings and counters of each run are written to this file,
+        # in the Prometheus text format if it ends with .prom or as JSON
+        # otherwise
+        self.metrics_file = config.get("metrics_file")
+
+        # Database statements are timed if either of these is set. Any
+        # statement slower than slow_query_seconds is logged, along with
+        # a random sample of query_sample_rate (0 to 1) of the others.
+        self.query_sample_rate = config.get("query_sample_rate", 0.0)
+        self.slow_query_seconds = config.get("slow_query_seconds")
+
+        # autotoggl-collector listens for events on this localhost port.
+        # Events are written once collector_flush_size are waiting, or
+        # every collector_flush_seconds, which is the most that can be
+        # lost if the collector is killed.
+        self.collector_port = config.get("collector_port", 47311)
+        self.collector_flush_size = config.get("collector_flush_size", 100)
+        self.collector_flush_seconds = config.get("collector_flush_seconds", 5.0)
+
+        # Applied to every database connection, including the collector's.
+        # WAL journaling lets the collector write while events are being
+        # read. mmap_bytes and cache_kib set how much of the database
+        # SQLite keeps in memory. A connection waits up to
+        # busy_timeout_seconds for another to release its lock.
+        self.db_journal_mode = config.get("db_journal_mode", "wal")
+        self.db_synchronous = config.get("db_synchronous", "normal")
+        self.db_mmap_bytes = config.get("db_mmap_bytes", 256 * 1024 * 1024)
+        self.db_cache_kib = config.get("db_cache_kib", 16 * 1024)
+        self.db_busy_timeout_seconds = config.get("db_busy_timeout_seconds", 5.0)
+
+        # If set, autotoggl-collector deletes consumed events older than
+        # retention_days. Each slice deletes up to retention_chunk_size
+        # events or frees up to retention_vacuum_pages pages, so writes are
+        # never held up for long. Once done, it checks again every
+        # retention_interval_seconds.
+        self.retention_days = config.get("retention_days")
+        self.retention_chunk_size = config.get("retention_chunk_size", 500)
+        self.retention_vacuum_pages = config.get("retention_vacuum_pages", 100)
+        self.retention_interval_seconds = config.get(
+            "retention_interval_seconds", 3600
+        )
+
+        # Store each process name and window title once and refer to them
+        # by id. The database is converted the first time this is set, and
+        # cannot be converted back.
+        self.normalized_storage = config.get("normalized_storage", False)
+
     def _load_from_clargs(self, args=None):
         if args is None:
             parser = ArgumentParser()
@@ -131,6 +245,40 @@ class Config:
                 help="Hour at which one day rolls over into the next.",
             )
 
+            parser.add_argument(
+                "--concurrency",
+                type=int,
+                dest="submit_concurrency",
+                help="Maximum number of time entries to submit at once.",
+            )
+
+            parser.add_argument(
+                "--merge_tolerance",
+                type=int,
+                dest="merge_tolerance_seconds",
+                help="Merge entries with the same project and description "
+                "that are separated by no more than this many seconds.",
+            )
+
+            parser.add_argument(
+                "--metrics",
+                type=str,
+                dest="metrics_file",
+                help="Write stage timings and counters to this file "
+                "(.prom for Prometheus, otherwise JSON).",
+            )
+
+            parser.add_argument(
+                "--profile",
+                choices=PROFILE_MODES,
+                nargs="?",
+                const=PROFILE_ALL,
+                default=None,
+                help="Profile the run with cProfile ('cpu'), tracemalloc "
+                "('memory') or both ('all', the default). Results are saved "
+                "next to toggl.db.",
+            )
+
             parser.add_argument(
                 "-catchup",
                 action="store_true",
@@ -138,6 +286,20 @@ class Config:
                 help="Reprocess any pending events that occurred before today",
             )
 
+            parser.add_argument(
+                "-resume",
+                action="store_true",
+                default=False,
+                help="Retry any submissions left over from previous runs",
+            )
+
+            parser.add_argument(
+                "-reconcile",
+                action="store_true",
+                default=False,
+                help="Only submit entries which do not already exist in Toggl",
+            )
+
             parser.add_argument(
                 "-local",
                 action="store_true",
@@ -195,6 +357,12 @@ class Config:
             "minimum_event_seconds",
             "day_ends_at",
             "catchup",
+            "resume",
+            "reconcile",
+            "submit_concurrency",
+            "merge_tolerance_seconds",
+            "metrics_file",
+            "profile",
         ]:
             if hasattr(args, attr) and getattr(args, attr) is not None:
                 setattr(self, attr, getattr(args, attr))
@@ -252,6 +420,9 @@ class Config:
         if self.clean and self.clean["before"]:
             self.clean["before"] = self.date
 
+        if self.metrics_file:
+            self.metrics_file = os.path.expanduser(self.metrics_file)
+
         if self.default_workspace:
             # Try to parse given workspace as an integer ID
             try:
@@ -269,9 +440,70 @@ class Config:
         for attr in [
             'minimum_event_seconds',
             'day_ends_at',
+            'classifier_cache_size',
+            'api_burst',
+            'submit_concurrency',
+            'outbox_retry_seconds',
+            'outbox_max_attempts',
+            'project_cache_ttl',
+            'merge_tolerance_seconds',
+            'collector_port',
+            'collector_flush_size',
+            'db_mmap_bytes',
+            'db_cache_kib',
+            'retention_chunk_size',
+            'retention_vacuum_pages',
+            'retention_interval_seconds',
         ]:
             if not isinstance(getattr(self, attr), int):
-                raise InvalidConfig(f"{attr} is invalid: '{self.day_ends_at}'")
+                raise InvalidConfig(f"{attr} is invalid: '{getattr(self, attr)}'")
+
+        if (not isinstance(self.api_requests_per_second, (int, float))
+                or self.api_requests_per_second <= 0):
+            raise InvalidConfig(
+                f"api_requests_per_second is invalid: "
+                f"'{self.api_requests_per_second}'")
+
+        if self.metrics_file is not None and not isinstance(self.metrics_file, str):
+            raise InvalidConfig(f"metrics_file is invalid: '{self.metrics_file}'")
+
+        if (not isinstance(self.query_sample_rate, (int, float))
+                or not 0 <= self.query_sample_rate <= 1):
+            raise InvalidConfig(
+                f"query_sample_rate is invalid: '{self.query_sample_rate}'")
+
+        if (not isinstance(self.collector_flush_seconds, (int, float))
+                or self.collector_flush_seconds <= 0):
+            raise InvalidConfig(
+                f"collector_flush_seconds is invalid: "
+                f"'{self.collector_flush_seconds}'")
+
+        for attr, choices in [
+            ("db_journal_mode", JOURNAL_MODES),
+            ("db_synchronous", SYNCHRONOUS),
+        ]:
+            if str(getattr(self, attr)).lower() not in choices:
+                raise InvalidConfig(f"{attr} is invalid: '{getattr(self, attr)}'")
+
+        if (not isinstance(self.db_busy_timeout_seconds, (int, float))
+                or self.db_busy_timeout_seconds < 0):
+            raise InvalidConfig(
+                f"db_busy_timeout_seconds is invalid: "
+                f"'{self.db_busy_timeout_seconds}'")
+
+        if not isinstance(self.normalized_storage, bool):
+            raise InvalidConfig(
+                f"normalized_storage is invalid: '{self.normalized_storage}'")
+
+        if self.retention_days is not None and not isinstance(
+                self.retention_days, int):
+            raise InvalidConfig(
+                f"retention_days is invalid: '{self.retention_days}'")
+
+        if self.slow_query_seconds is not None and not isinstance(
+                self.slow_query_seconds, (int, float)):
+            raise InvalidConfig(
+                f"slow_query_seconds is invalid: '{self.slow_query_seconds}'")
 
     def day_starts(self):
         return self.day_starts
@@ -283,10 +515,36 @@ class Config:
         date = int(self.date.timestamp()) if self.date else None
         return {
             "api_key": self.api_key,
+            "api_base": self.api_base,
             "default_workspace": self.default_workspace,
             "default_day": self.default_day,
             "minimum_event_seconds": self.minimum_event_seconds,
             "day_ends_at": self.day_ends_at,
+            "classifier_cache_size": self.classifier_cache_size,
+            "api_requests_per_second": self.api_requests_per_second,
+            "api_burst": self.api_burst,
+            "submit_concurrency": self.submit_concurrency,
+            "outbox_retry_seconds": self.outbox_retry_seconds,
+            "outbox_max_attempts": self.outbox_max_attempts,
+            "project_cache_ttl": self.project_cache_ttl,
+            "merge_tolerance_seconds": self.merge_tolerance_seconds,
+            "metrics_file": self.metrics_file,
+            "profile": self.profile,
+            "query_sample_rate": self.query_sample_rate,
+            "slow_query_seconds": self.slow_query_seconds,
+            "collector_port": self.collector_port,
+            "collector_flush_size": self.collector_flush_size,
+            "collector_flush_seconds": self.collector_flush_seconds,
+            "db_journal_mode": self.db_journal_mode,
+            "db_synchronous": self.db_synchronous,
+            "db_mmap_bytes": self.db_mmap_bytes,
+            "db_cache_kib": self.db_cache_kib,
+            "db_busy_timeout_seconds": self.db_busy_timeout_seconds,
+            "retention_days": self.retention_days,
+            "retention_chunk_size": self.retention_chunk_size,
+            "retention_vacuum_pages": self.retention_vacuum_pages,
+            "retention_interval_seconds": self.retention_interval_seconds,
+            "normalized_storage": self.normalized_storage,
             "date": date,
             "project_definitions": [x.as_json() for _, x in self.classifiers.items()],
             "local": self.local,
@@ -296,6 +554,8 @@ class Config:
             "clean": self.clean,
             "config": self.config,
             "catchup": self.catchup,
+            "resume": self.resume,
+            "reconcile": self.reconcile,
         }
 
     def _create_example_file(self, filename):
@@ -351,6 +611,23 @@ class Config:
             )
 
 
+def _hash_definitions(definitions) -> str:
+    """
+    Fingerprint of the raw project_definitions, used to invalidate stored
+    classifier results whenever the definitions are changed.
+    """
+    return hashlib.sha1(
+        json.dumps(definitions, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def _compile_all(patterns) -> list:
+    """Compile a pattern, or list of patterns, into a list."""
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return [re.compile(p) for p in patterns]
+
+
 class ClassifierResult:
     def __init__(self, **kwargs):
         self.project = kwargs.get("project")
@@ -380,24 +657,43 @@ class Classifier:
         self.tags = json_data.get("tags", [])
         self.tag_pattern = json_data.get("tag_pattern", [])
 
-    def get(self, window_title):
+        self._compile()
+
+    def _compile(self):
+        """
+        Compile all patterns once so that classifying an event does not
+        need to look anything up in the re module cache.
+        """
+        self._project_re = (
+            re.compile(self.project_pattern) if self.project_pattern else None
+        )
+        self._description_res = _compile_all(self.description_pattern)
+        self._tag_res = _compile_all(self.tag_pattern)
+
+    def get(self, window_title, lowered=None):
+        """
+        `lowered` may be passed by a caller that has already lower-cased
+        window_title, so that it only needs to happen once per title.
+        """
         project = None
         description = None
         tags = self.tags[:]
 
-        if self.project_pattern:
-            project = self._match_patterns([self.project_pattern], window_title)
-        description = self._match_patterns(self.description_pattern, window_title)
-        tags += self._match_multi_patterns(self.tag_pattern, window_title)
+        if self._project_re:
+            project = self._match_patterns([self._project_re], window_title)
+        description = self._match_patterns(self._description_res, window_title)
+        tags += self._match_multi_patterns(self._tag_res, window_title)
 
-        for x in self.window_contains:
-            if x in window_title.lower():
+        if self.window_contains:
+            if lowered is None:
+                lowered = window_title.lower()
+            x = self._match_contains(lowered)
+            if x is not None:
                 project = project or self.project_title
                 description = description or self.description
                 if description == Classifier.USE_MATCH:
                     description = x
                 tags = [x if t == Classifier.USE_MATCH else t for t in tags]
-                break
 
         if not self.project_pattern and not self.window_contains:
             project = self.project_title
@@ -412,10 +708,22 @@ class Classifier:
                 project=self._alias(project), description=description, tags=tags
             )
 
+    def _match_contains(self, lowered) -> Optional[str]:
+        """
+        Return the first entry of window_contains (in configured order)
+        that appears in the lower-cased window title.
+
+        A plain substring test per entry is faster than a combined regex
+        alternation, which has to try every entry at every position.
+        """
+        for x in self.window_contains:
+            if x in lowered:
+                return x
+
     def _match_patterns(self, patterns, text) -> str:
         """Get the first matching group."""
         for p in patterns:
-            m = re.match(p, text)
+            m = p.match(text)
             if m:
                 return m.group(1)
 
@@ -423,7 +731,7 @@ class Classifier:
         """Return the first matching group for multiple patterns."""
         results = []
         for p in patterns:
-            m = re.match(p, text)
+            m = p.match(text)
             if m:
                 results.append(m.group(1))
         return results
@@ -473,10 +781,13 @@ class ProcessClassifier(Classifier):
         self.process = json_data.get("process")
         self.projects = [Project(x) for x in json_data.get("projects", [])]
 
-    def get(self, window_title):
+    def get(self, window_title, lowered=None):
+        if lowered is None:
+            lowered = window_title.lower()
+
         result = None
         for x in self.projects:
-            result = x.get(window_title)
+            result = x.get(window_title, lowered)
             if result:
                 break
 
@@ -484,7 +795,7 @@ class ProcessClassifier(Classifier):
             result.tags += self.tags
             return result
 
-        return super().get(window_title)
+        return super().get(window_title, lowered)
 
     def __repr__(self):
         return json.dumps(
@@ -0,0 +1,196 @@
+import json
+import os
+import threading
+import time
+
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+
+class Stage:
+    '''Wall time and item counts recorded for one stage of a run'''
+
+    __slots__ = ['name', 'seconds', 'calls', 'items_in', 'items_out',
+                 'source']
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.calls = 0
+        self.items_in = None
+        self.items_out = None
+
+        # Name of the stage whose output is streamed into this one, so
+        # that items_in can be taken from its items_out
+        self.source = None
+
+    def as_json(self) -> dict:
+        return {
+            'seconds': self.seconds,
+            'calls': self.calls,
+            'items_in': self.items_in,
+            'items_out': self.items_out,
+        }
+
+
+class Metrics:
+    '''
+    Per-stage wall time and counters for a single run.
+
+    Stages may be nested, or chained together as generators which
+    interleave their work. In both cases a stage is only charged for
+    time spent in its own code: time spent in any stage it calls into
+    is subtracted, so stage timings add up to the total.
+
+    Counters may be updated from any thread, but stages should only be
+    measured on the thread that called main().
+    '''
+
+    def __init__(self, clock=time.perf_counter):
+        self.stages = OrderedDict()
+        self.counters = Counter()
+        self.started = time.time()
+
+        self._clock = clock
+        self._lock = threading.Lock()
+
+        # Time spent in nested stages, for each stage currently running
+        self._children = []
+
+        # Called with the name of each stage when it finishes, e.g. by
+        # autotoggl.profiling to take memory snapshots between stages
+        self.on_stage_end = None
+
+    def __repr__(self):
+        stages = ', '.join(
+            '{}={:.3f}s'.format(s.name, s.seconds)
+            for s in self.stages.values())
+        return 'Metrics({}) {}'.format(stages, dict(self.counters))
+
+    def _stage(self, name) -> Stage:
+        if name not in self.stages:
+            self.stages[name] = Stage(name)
+        return self.stages[name]
+
+    def _enter(self) -> float:
+        self._children.append(0.0)
+        return self._clock()
+
+    def _exit(self, stage, started) -> None:
+        elapsed = self._clock() - started
+        stage.seconds += elapsed - self._children.pop()
+        if self._children:
+            self._children[-1] += elapsed
+
+    @contextmanager
+    def stage(self, name, items_in=None):
+        '''
+        Measure the body of a with block. The Stage is returned so that
+        items_out can be set once the result is known.
+        '''
+        stage = self._stage(name)
+        stage.calls += 1
+        if items_in is not None:
+            stage.items_in = (stage.items_in or 0) + items_in
+        started = self._enter()
+        try:
+            yield stage
+        finally:
+            self._exit(stage, started)
+            self._stage_ended(stage)
+
+    def iterate(self, name, iterable, source=None):
+        '''
+        Yield from iterable, charging the time taken to produce each item
+        to the named stage and counting the items produced.
+        '''
+        stage = self._stage(name)
+        stage.calls += 1
+        stage.source = source
+        stage.items_out = stage.items_out or 0
+        return self._iterate(stage, iter(iterable))
+
+    def _iterate(self, stage, iterator):
+        while True:
+            started = self._enter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._exit(stage, started)
+                self._stage_ended(stage)
+                return
+            except BaseException:
+                self._exit(stage, started)
+                raise
+            self._exit(stage, started)
+            stage.items_out += 1
+            yield item
+
+    def _stage_ended(self, stage) -> None:
+        if self.on_stage_end is not None:
+            self.on_stage_end(stage.name)
+
+    def count(self, name, value=1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    def as_json(self) -> dict:
+        stages = OrderedDict()
+        for name, stage in self.stages.items():
+            stages[name] = stage.as_json()
+            if stage.source in self.stages:
+                stages[name]['items_in'] = self.stages[stage.source].items_out
+
+        return {
+            'started': self.started,
+            'seconds': sum(s.seconds for s in self.stages.values()),
+            'stages': stages,
+            'counters': dict(self.counters),
+        }
+
+    def as_prometheus(self, prefix='autotoggl') -> str:
+        '''Format for the node_exporter textfile collector'''
+        data = self.as_json()
+        lines = []
+
+        def metric(name, help, samples):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help))
+            lines.append('# TYPE {}_{} gauge'.format(prefix, name))
+            for labels, value in samples:
+                lines.append('{}_{}{} {}'.format(prefix, name, labels, value))
+
+        metric('last_run_timestamp_seconds',
+               'Time at which the last run started',
+               [('', data['started'])])
+        metric('run_seconds', 'Wall time of the last run',
+               [('', data['seconds'])])
+        for field, help in [
+                ('seconds', 'Wall time spent in each stage'),
+                ('items_in', 'Number of items passed into each stage'),
+                ('items_out', 'Number of items produced by each stage')]:
+            samples = [
+                ('{{stage="{}"}}'.format(name), stage[field])
+                for name, stage in data['stages'].items()
+                if stage[field] is not None]
+            if samples:
+                metric('stage_' + field, help, samples)
+        for name, value in sorted(data['counters'].items()):
+            metric(name, name.replace('_', ' ').capitalize(), [('', value)])
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename) -> None:
+        '''
+        Write metrics as JSON, or in the Prometheus text format if
+        filename ends with .prom. The file is replaced atomically so
+        that a scraper never reads it half written.
+        '''
+        if filename.endswith('.prom'):
+            content = self.as_prometheus()
+        else:
+            content = json.dumps(self.as_json(), indent=2)
+
+        temp = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(temp, 'w') as f:
+            f.write(content)
+        os.replace(temp, filename)
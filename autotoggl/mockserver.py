@@ -0,0 +1,271 @@
+'''
+Local stand-in for the parts of the Toggl v8 API used by
+TogglApiInterface: workspaces, projects and time_entries.
+
+It keeps everything in memory and can add latency, rate limiting with
+HTTP 429 responses, and failures, so that submission can be tested and
+measured without credentials or network access.
+
+Usage:
+    python -m autotoggl.mockserver --port 8080 --latency 0.05 --rate 1
+
+Then point autotoggl at it by setting AUTOTOGGL_API_BASE to the printed
+URL, or `api_base` in config.json.
+'''
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+
+from argparse import ArgumentParser
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+API_PATH = '/api/v8/'
+
+
+def _init_logger(name=__file__, level=logging.INFO):
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    logger.addHandler(logging.StreamHandler())
+    return logger
+
+
+logger = _init_logger()
+
+
+class MockTogglServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0,
+                 rate_limit=None, burst=1, failure_rate=0.0,
+                 fail_descriptions=(), workspaces=None, seed=None):
+        super().__init__(address, _Handler)
+
+        # Seconds added to every response
+        self.latency = latency
+
+        # Requests per second allowed before responding with HTTP 429
+        self.rate_limit = rate_limit
+        self.burst = burst
+
+        # Probability that any request fails with HTTP 500
+        self.failure_rate = failure_rate
+
+        # Time entries with any of these descriptions are rejected
+        # with HTTP 400
+        self.fail_descriptions = set(fail_descriptions)
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.workspaces = workspaces or [{'id': 1, 'name': 'Workspace'}]
+        self.projects = []
+        self.time_entries = []
+        self._next_id = 1000
+
+        # Counters for inspecting how the client behaved
+        self.requests = 0
+        self.rate_limited = 0
+        self.failed = 0
+
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return 'http://{}:{}{}'.format(host, port, API_PATH)
+
+    def start(self) -> 'MockTogglServer':
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, ctx_type, ctx_value, ctx_traceback):
+        self.stop()
+
+    def _take_token(self) -> float:
+        '''
+        Returns 0 if the request is allowed, otherwise the number of
+        seconds until it would be.
+        '''
+        if not self.rate_limit:
+            return 0
+        now = time.monotonic()
+        self._tokens = min(
+            self.burst,
+            self._tokens + (now - self._updated) * self.rate_limit)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate_limit
+
+    def _id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    def respond(self, method, path, query, body):
+        '''
+        Returns (status, json data, headers) for the given request.
+        '''
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            self.requests += 1
+
+            wait = self._take_token()
+            if wait:
+                self.rate_limited += 1
+                return 429, None, {'Retry-After': str(math.ceil(wait))}
+
+            if self.failure_rate and self.random.random() < self.failure_rate:
+                self.failed += 1
+                return 500, {'error': 'Injected failure'}, {}
+
+            return self._route(method, path, query, body)
+
+    def _route(self, method, path, query, body):
+        if method == 'GET' and path == 'workspaces':
+            return 200, self.workspaces, {}
+
+        m = re.fullmatch(r'workspaces/(\d+)/projects', path)
+        if method == 'GET' and m:
+            wid = int(m.group(1))
+            projects = [p for p in self.projects if p['wid'] == wid]
+
+            # Toggl returns null rather than an empty list
+            return 200, projects or None, {}
+
+        if method == 'POST' and path == 'projects':
+            project = dict(body['project'], id=self._id())
+            self.projects.append(project)
+            return 200, {'data': project}, {}
+
+        m = re.fullmatch(r'projects/(\d+)', path)
+        if method == 'DELETE' and m:
+            pid = int(m.group(1))
+            self.projects = [p for p in self.projects if p['id'] != pid]
+            return 200, None, {}
+
+        if method == 'POST' and path == 'time_entries':
+            entry = body['time_entry']
+            if entry.get('description') in self.fail_descriptions:
+                self.failed += 1
+                return 400, {'error': 'Injected failure'}, {}
+            entry = dict(entry, id=self._id())
+            self.time_entries.append(entry)
+            return 200, {'data': entry}, {}
+
+        if method == 'GET' and path == 'time_entries':
+            start = _timestamp(query.get('start_date', [None])[0], 0)
+            end = _timestamp(query.get('end_date', [None])[0], math.inf)
+            return 200, [
+                e for e in self.time_entries
+                if start <= _timestamp(e['start'], 0) <= end], {}
+
+        return 404, {'error': 'Not found'}, {}
+
+
+def _timestamp(iso, default) -> float:
+    if not iso:
+        return default
+    return datetime.fromisoformat(iso).timestamp()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        if not self.headers.get('Authorization'):
+            status, data, headers = 403, {'error': 'Unauthorized'}, {}
+        elif not url.path.startswith(API_PATH):
+            status, data, headers = 404, {'error': 'Not found'}, {}
+        else:
+            status, data, headers = self.server.respond(
+                method,
+                url.path[len(API_PATH):],
+                parse_qs(url.query),
+                body)
+
+        content = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help='Seconds added to every response')
+    parser.add_argument(
+        '--rate', type=float, default=None,
+        help='Requests per second allowed before responding with HTTP 429')
+    parser.add_argument('--burst', type=int, default=1)
+    parser.add_argument(
+        '--failure_rate', type=float, default=0.0,
+        help='Probability that any request fails with HTTP 500')
+    parser.add_argument(
+        '--workspace', default='Workspace',
+        help='Name of the single workspace')
+    args = parser.parse_args()
+
+    server = MockTogglServer(
+        (args.host, args.port),
+        latency=args.latency,
+        rate_limit=args.rate,
+        burst=args.burst,
+        failure_rate=args.failure_rate,
+        workspaces=[{'id': 1, 'name': args.workspace}])
+    logger.info('Serving mock Toggl API at {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
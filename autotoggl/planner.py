@@ -0,0 +1,72 @@
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+
+def plan_entries(projects, tolerance) -> Tuple[Dict[str, List], int]:
+    '''
+    Coalesce time entries before they are submitted.
+
+    Within each project, consecutive entries with the same description are
+    merged when the gap between the end of one and the start of the next
+    is no more than `tolerance` seconds. Merged entries keep the start of
+    the first entry and the total of their durations, so tracked time is
+    not inflated by the gaps.
+
+    Entries are never merged across an entry from any project which
+    starts in the gap, as the merged entry would then overlap it.
+
+    Entries are processed in order of (start, id) so the result only
+    depends on the input, meaning a -local preview shows exactly what
+    will be submitted.
+
+    Returns the planned projects dictionary and the number of API calls
+    saved by merging.
+    '''
+    entries = sorted(
+        ((project, e) for project in projects for e in projects[project]),
+        key=lambda x: (x[1].start, x[1].id))
+    starts = [e.start for _, e in entries]
+
+    planned = {project: [] for project in sorted(projects)}
+    saved = 0
+
+    # The entry that later entries of each project may be merged into,
+    # and the time at which it ends
+    current = {}
+    for project, e in entries:
+        c = current.get(project)
+        if c is not None:
+            previous, previous_end = c
+            if (e.description == previous.description
+                    and e.start - previous_end <= tolerance
+                    and not _starts_between(starts, previous_end, e.start)):
+                _absorb(previous, e)
+                current[project] = (
+                    previous, max(previous_end, e.start + e.duration))
+                saved += 1
+                continue
+
+        current[project] = (e, e.start + e.duration)
+        planned[project].append(e)
+
+    return planned, saved
+
+
+def _starts_between(starts, begin, end) -> bool:
+    '''True if any of the sorted starts is in [begin, end)'''
+    return bisect_left(starts, begin) < bisect_left(starts, end)
+
+
+def _absorb(entry, other) -> None:
+    '''
+    Merge other into entry, along with any events already merged into
+    other, so that all of them are consumed when entry is submitted.
+    '''
+    entry.duration += other.duration
+    entry.merged.append(other.id)
+    entry.merged.extend(other.merged)
+
+    # Tags may be shared with other events, so build a new list
+    tags = list(entry.tags)
+    tags += [t for t in other.tags if t not in tags]
+    entry.tags = tags
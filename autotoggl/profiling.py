@@ -0,0 +1,107 @@
+import cProfile
+import datetime
+import os
+import tracemalloc
+
+from typing import List, Optional
+
+
+# Values accepted by --profile
+PROFILE_CPU = 'cpu'
+PROFILE_MEMORY = 'memory'
+PROFILE_ALL = 'all'
+PROFILE_MODES = [PROFILE_CPU, PROFILE_MEMORY, PROFILE_ALL]
+
+
+class Profiler:
+    '''
+    Profile a run with cProfile and/or tracemalloc.
+
+    cProfile statistics are saved in a .pstats file, which can be read
+    with `python -m pstats` or snakeviz. Memory is snapshotted whenever
+    snapshot() is called, normally at the end of each stage recorded by
+    autotoggl.metrics, and a report of the largest allocations and the
+    change since the previous snapshot is saved alongside it.
+
+    tracemalloc slows down everything it traces, so for accurate timings
+    profile 'cpu' and 'memory' in separate runs.
+    '''
+
+    def __init__(self, mode, directory, top=25):
+        if mode not in PROFILE_MODES:
+            raise ValueError('Unknown profile mode: {}'.format(mode))
+        self.cpu = mode in (PROFILE_CPU, PROFILE_ALL)
+        self.memory = mode in (PROFILE_MEMORY, PROFILE_ALL)
+        self.top = top
+
+        name = 'profile-{}'.format(
+            datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+        self.stats_file = os.path.join(directory, name + '.pstats')
+        self.allocations_file = os.path.join(
+            directory, name + '-allocations.txt')
+
+        self._profile: Optional[cProfile.Profile] = None
+        self._previous: Optional[tracemalloc.Snapshot] = None
+        self._report: List[str] = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, ctx_type, ctx_value, ctx_traceback):
+        self.stop()
+
+    def start(self) -> None:
+        if self.memory:
+            tracemalloc.start()
+            self.snapshot('start')
+        if self.cpu:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def snapshot(self, label) -> None:
+        '''Add the current allocations to the report'''
+        if not self.memory or not tracemalloc.is_tracing():
+            return
+
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+
+        self._report.append(
+            '=== {}: current {:.1f} KiB, peak {:.1f} KiB ==='
+            .format(label, current / 1024, peak / 1024))
+        self._report.append('Top {} lines:'.format(self.top))
+        for stat in snapshot.statistics('lineno')[:self.top]:
+            self._report.append('  {}'.format(stat))
+
+        if self._previous is not None:
+            self._report.append('Change since previous snapshot:')
+            for stat in snapshot.compare_to(
+                    self._previous, 'lineno')[:self.top]:
+                self._report.append('  {}'.format(stat))
+        self._report.append('')
+
+        self._previous = snapshot
+
+    def stop(self) -> List[str]:
+        '''Save the results and return the names of the files written'''
+        written = []
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.dump_stats(self.stats_file)
+            self._profile = None
+            written.append(self.stats_file)
+
+        if self.memory and tracemalloc.is_tracing():
+            self.snapshot('end')
+            tracemalloc.stop()
+            with open(self.allocations_file, 'w') as f:
+                f.write('\n'.join(self._report))
+            self._previous = None
+            written.append(self.allocations_file)
+
+        return written
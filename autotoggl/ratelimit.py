@@ -0,0 +1,90 @@
+import threading
+import time
+
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket rate limiter.
+
+    Tokens are added at `rate` per second up to `capacity`, and every
+    request takes one token, waiting for it if necessary. When the server
+    responds with HTTP 429, backoff() stops all requests until its
+    Retry-After period has passed and halves the rate. Each successful
+    request then recovers a little of the rate, up to the configured
+    maximum, so throughput settles at whatever the server will accept.
+    '''
+
+    # Fraction of the maximum rate recovered by each successful request
+    RECOVERY = 0.05
+
+    # The rate is never reduced below this fraction of the maximum
+    MINIMUM = 1 / 64
+
+    def __init__(self, rate=1.0, capacity=1,
+                 clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError('rate must be greater than zero')
+        self.rate = rate
+        self.max_rate = rate
+        self.capacity = max(1, capacity)
+
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+
+        self._tokens = float(self.capacity)
+        self._updated = clock()
+        self._blocked_until = 0.0
+
+    def _refill(self, now) -> None:
+        # No tokens are earned while requests are blocked by backoff()
+        elapsed = now - max(self._updated, self._blocked_until)
+        if elapsed > 0:
+            self._tokens = min(
+                self.capacity, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def acquire(self) -> float:
+        '''
+        Take a token, blocking until one is available.
+        Returns the number of seconds spent waiting.
+        '''
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._refill(now)
+                if now < self._blocked_until:
+                    wait = self._blocked_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                else:
+                    wait = (1 - self._tokens) / self.rate
+
+            self._sleep(wait)
+            waited += wait
+
+    def backoff(self, seconds) -> None:
+        '''
+        Block all requests for the given number of seconds, e.g. from
+        the Retry-After header of an HTTP 429 response, and halve the rate.
+        '''
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            self._blocked_until = max(self._blocked_until, now + seconds)
+            self.rate = max(self.max_rate * self.MINIMUM, self.rate / 2)
+
+            # Allow a single request once the block has passed, then
+            # continue at the normal rate
+            self._tokens = min(self._tokens, 1.0)
+
+    def succeeded(self) -> None:
+        '''Recover some of the rate after a request was accepted'''
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill(self._clock())
+                self.rate = min(
+                    self.max_rate,
+                    self.rate + self.max_rate * self.RECOVERY)
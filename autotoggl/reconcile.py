@@ -0,0 +1,51 @@
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+
+def reconcile(interface, projects) -> Tuple[Dict[str, List], List]:
+    '''
+    Compare planned entries with the time entries that already exist in
+    Toggl, e.g. after a -reset, so that they are not submitted twice.
+
+    Remote entries for the whole range are fetched with a single request
+    and indexed by (start, duration, project id, description), so each
+    planned entry is matched with one lookup.
+
+    Returns the projects dictionary of entries which still need to be
+    submitted, and a list of entries which already exist.
+    '''
+    entries = [e for events in projects.values() for e in events]
+    if not entries:
+        return projects, []
+
+    start = min(e.start for e in entries)
+    end = max(e.start for e in entries) + 1
+    remote = interface.get_time_entries(start, end) or []
+
+    # Counted, so that identical remote entries each match only once
+    index = Counter(_remote_key(r) for r in remote)
+
+    remaining = {}
+    matched = []
+    for p, events in projects.items():
+        pid = interface.projects.get(p, {}).get('pid')
+        for e in events:
+            key = (int(e.start), int(e.duration), pid, e.description or '')
+            if pid is not None and index[key] > 0:
+                index[key] -= 1
+                matched.append(e)
+            else:
+                remaining.setdefault(p, []).append(e)
+
+    return remaining, matched
+
+
+def _remote_key(entry) -> tuple:
+    start = int(datetime.fromisoformat(entry['start']).timestamp())
+    return (
+        start,
+        int(entry.get('duration', 0)),
+        entry.get('pid'),
+        entry.get('description') or '',
+    )
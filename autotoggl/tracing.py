@@ -0,0 +1,169 @@
+import logging
+import random
+import threading
+import time
+
+from collections import OrderedDict, deque
+from typing import List
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueryRecord:
+    '''A single traced statement'''
+
+    __slots__ = ['sql', 'parameters', 'seconds', 'rows']
+
+    def __init__(self, sql, parameters, seconds, rows):
+        self.sql = sql
+        self.parameters = parameters
+        self.seconds = seconds
+        self.rows = rows
+
+    def __repr__(self):
+        return '{:.3f}ms params={} rows={}: {}'.format(
+            self.seconds * 1000, self.parameters, self.rows,
+            _abbreviate(self.sql))
+
+
+class StatementStats:
+    '''Totals for every execution of one SQL statement'''
+
+    __slots__ = ['sql', 'calls', 'parameters', 'rows', 'seconds',
+                 'max_seconds']
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.calls = 0
+        self.parameters = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def __repr__(self):
+        return (
+            '{:9.3f}ms total {:8.3f}ms max {:6} calls {:8} rows: {}'
+            .format(
+                self.seconds * 1000, self.max_seconds * 1000,
+                self.calls, self.rows, _abbreviate(self.sql)))
+
+    def as_json(self) -> dict:
+        return {
+            'sql': self.sql,
+            'calls': self.calls,
+            'parameters': self.parameters,
+            'rows': self.rows,
+            'seconds': self.seconds,
+            'max_seconds': self.max_seconds,
+        }
+
+
+def _abbreviate(sql, length=80) -> str:
+    sql = ' '.join(sql.split())
+    return sql if len(sql) <= length else sql[:length - 3] + '...'
+
+
+class _Counter:
+    '''Iterator which counts the items it passes on'''
+
+    __slots__ = ['_iterator', 'count']
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self._iterator)
+        self.count += 1
+        return item
+
+
+class QueryTracer:
+    '''
+    Time the statements run by DatabaseManager.
+
+    Every statement is added to per-statement totals. A sample of
+    sample_rate of them is also kept in `records`, along with every
+    statement slower than slow_seconds, which is logged as a warning.
+    Parameter values are never kept, only how many there were.
+
+    DatabaseManager skips all of this when it has no tracer.
+    '''
+
+    def __init__(self, sample_rate=0.0, slow_seconds=None, max_records=1000,
+                 clock=time.perf_counter, sample=random.random):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.records = deque(maxlen=max_records)
+        self.statements = OrderedDict()
+
+        self._clock = clock
+        self._sample = sample
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'QueryTracer({} statements, {} calls, {:.3f}s)'.format(
+            len(self.statements),
+            sum(s.calls for s in self.statements.values()),
+            sum(s.seconds for s in self.statements.values()))
+
+    def execute(self, execute, sql, parameters=(), many=False):
+        '''
+        Call execute(sql, parameters) and record how long it took. If
+        many is True then parameters is a sequence of parameter sets for
+        executemany, which are counted as they are consumed so that a
+        generator does not need to be held in memory.
+        '''
+        if many:
+            counter = _Counter(parameters)
+            started = self._clock()
+            cursor = execute(sql, counter)
+            seconds = self._clock() - started
+            count = counter.count
+        else:
+            started = self._clock()
+            cursor = execute(sql, parameters)
+            seconds = self._clock() - started
+            count = len(parameters)
+
+        self.record(sql, count, seconds, max(cursor.rowcount, 0))
+        return cursor
+
+    def record(self, sql, parameters, seconds, rows) -> None:
+        with self._lock:
+            stats = self.statements.get(sql)
+            if stats is None:
+                stats = self.statements[sql] = StatementStats(sql)
+            stats.calls += 1
+            stats.parameters += parameters
+            stats.rows += rows
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+
+            slow = (self.slow_seconds is not None
+                    and seconds >= self.slow_seconds)
+            if slow or (self.sample_rate and
+                        self._sample() < self.sample_rate):
+                record = QueryRecord(sql, parameters, seconds, rows)
+                self.records.append(record)
+            else:
+                return
+
+        if slow:
+            logger.warning('Slow query: {}'.format(record))
+        else:
+            logger.debug('Query: {}'.format(record))
+
+    def slowest(self, n=10) -> List[StatementStats]:
+        '''Statements which took the most time in total'''
+        return sorted(
+            self.statements.values(),
+            key=lambda s: s.seconds, reverse=True)[:n]
+
+    def summary(self, n=10) -> str:
+        return '\n'.join(
+            [repr(self)] + ['  {}'.format(s) for s in self.slowest(n)])
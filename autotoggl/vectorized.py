@@ -0,0 +1,79 @@
+'''
+Optional NumPy implementation of the compression stage for EventBatch.
+
+The pure-Python state machine in autotoggl.iter_compress_events is used
+whenever NumPy is not installed.
+'''
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def available() -> bool:
+    return np is not None
+
+
+def compress(starts, last_duration, titles, assigned, system_title,
+             minimum):
+    '''
+    Vectorized equivalent of iter_compress_events.
+
+    `starts` is a buffer of int64 start times in order of occurrence,
+    `titles` the window title of each row and `assigned` whether each
+    row has a project.
+
+    Returns (openers, durations, closes) arrays: the row index of each
+    compressed event, its total duration and the index of the row that
+    ended it. Rows between an opener and its close have been merged into
+    the opener.
+    '''
+    n = len(titles)
+    if n == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+
+    starts = np.frombuffer(starts, dtype=np.int64)
+
+    # Naive durations, until the next event starts
+    durations = np.empty(n, dtype=np.int64)
+    durations[:-1] = np.diff(starts)
+    durations[-1] = last_duration
+
+    # Identical titles share a code
+    codes = {}
+    title_codes = np.fromiter(
+        (codes.setdefault(t, len(codes)) for t in titles),
+        dtype=np.int64, count=n)
+    system = title_codes == codes.get(system_title, -1)
+    assigned = np.fromiter(assigned, dtype=bool, count=n)
+
+    # Events which are long enough to take over from an ongoing event
+    strong = ~system & (durations >= minimum) & assigned
+    candidates = np.flatnonzero(strong)
+    if candidates.size == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+
+    # A system event breaks any ongoing event, so strong events are
+    # grouped into runs of identical titles within each segment between
+    # system events. The first event of each run is an opener and the
+    # rest of the run is merged into it.
+    segments = np.cumsum(system)
+    opens = np.ones(candidates.size, dtype=bool)
+    opens[1:] = (
+        (segments[candidates[1:]] != segments[candidates[:-1]])
+        | (title_codes[candidates[1:]] != title_codes[candidates[:-1]]))
+    openers = candidates[opens]
+
+    # Each opener absorbs every row up to the next opener or system event
+    boundaries = np.union1d(openers, np.flatnonzero(system))
+    boundaries = np.append(boundaries, n)
+    closes = boundaries[np.searchsorted(boundaries, openers, side='right')]
+
+    cumulative = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(durations, out=cumulative[1:])
+    totals = cumulative[closes] - cumulative[openers]
+
+    keep = totals != 0
+    return openers[keep], totals[keep], closes[keep]
@@ -0,0 +1,111 @@
+'''
+Range query latency on the toggl table, before and after the schema
+migrations have added their indexes.
+
+Usage:
+    python -m benchmarks.bench_db [--rows 2000000] [--path /tmp/bench.db]
+'''
+import datetime
+import logging
+import os
+import random
+import sqlite3
+import time
+
+from argparse import ArgumentParser
+from datetime import timedelta
+
+import autotoggl.autotoggl as autotoggl
+
+
+TITLES = [
+    ('chrome', 'reddit: the front page of the internet'),
+    ('chrome', 'Google'),
+    ('sublime_text', '/auto-toggl/autotoggl.py (auto-toggl) - Sublime Text'),
+    ('studio64', 'Commons - [/path/to/project] - File.java - Android Studio'),
+    ('System.Idle', autotoggl.EVENT_SYSTEM),
+]
+
+
+def build_database(path, rows, seed=0) -> int:
+    '''
+    Write `rows` events, one every 30 seconds on average, into a database
+    with the original unindexed schema. Returns the timestamp of the
+    first event.
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+
+    rng = random.Random(seed)
+    first = int(datetime.datetime(2015, 1, 1).timestamp())
+
+    conn = sqlite3.connect(path)
+    conn.execute(
+        '''CREATE TABLE toggl
+           (process_name TEXT NOT NULL,
+           window_title TEXT NOT NULL,
+           start INTEGER NOT NULL,
+           consumed BOOLEAN NOT NULL DEFAULT 0)''')
+
+    def generate():
+        start = first
+        for n in range(rows):
+            process, title = rng.choice(TITLES)
+            start += rng.randint(1, 60)
+            yield process, title, start, n < rows * 0.95
+
+    conn.executemany(
+        '''INSERT INTO toggl VALUES (?, ?, ?, ?)''', generate())
+    conn.commit()
+    conn.close()
+    return first
+
+
+def time_range_queries(db, first, days, repeat) -> float:
+    '''Mean seconds taken by get_events for one day at random offsets'''
+    rng = random.Random(1)
+    timings = []
+    for _ in range(repeat):
+        start = datetime.datetime.fromtimestamp(first) + timedelta(
+            days=rng.randint(0, max(days - 1, 0)))
+        t = time.perf_counter()
+        db.get_events(start, start + timedelta(days=1))
+        timings.append(time.perf_counter() - t)
+    return sum(timings) / len(timings)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--path', default='/tmp/autotoggl-bench.db')
+    args = parser.parse_args()
+
+    autotoggl.logger.setLevel(logging.WARNING)
+
+    print('Building database with {} rows...'.format(args.rows))
+    first = build_database(args.path, args.rows)
+    days = args.rows * 30 // 86400
+
+    # Temporarily open without migrations to measure the original schema
+    migrations = autotoggl.MIGRATIONS
+    autotoggl.MIGRATIONS = []
+    with autotoggl.DatabaseManager(filename=args.path) as db:
+        before = time_range_queries(db, first, days, args.repeat)
+    autotoggl.MIGRATIONS = migrations
+
+    t = time.perf_counter()
+    with autotoggl.DatabaseManager(filename=args.path) as db:
+        migrated = time.perf_counter() - t
+        after = time_range_queries(db, first, days, args.repeat)
+
+    print('One-day range query over {} rows:'.format(args.rows))
+    print('  unindexed: {:8.2f} ms'.format(before * 1000))
+    print('  indexed:   {:8.2f} ms'.format(after * 1000))
+    print('  migration: {:8.2f} s'.format(migrated))
+
+    os.remove(args.path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+'''
+Time each stage of the local pipeline over generated workloads.
+
+Stages are timed separately for the list-of-Event path used by main()
+and the EventBatch path. Results are written as JSON so that runs on
+different commits can be compared.
+
+Usage:
+    python -m benchmarks.bench_pipeline [--rows 10000 100000 1000000]
+        [--repeat 3] [--output results.json] [--compare baseline.json]
+'''
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+import autotoggl.autotoggl as autotoggl
+from autotoggl import render, vectorized
+
+from benchmarks.workload import build_database, get_config
+
+
+def _timed(results, stage, items_in, function, *args, **kwargs):
+    t = time.perf_counter()
+    value = function(*args, **kwargs)
+    results.append({
+        'stage': stage,
+        'seconds': time.perf_counter() - t,
+        'items_in': items_in,
+        'items_out': len(value) if hasattr(value, '__len__') else None,
+    })
+    return value
+
+
+def run_events(db, config, start, end, preview):
+    '''One pass through the stages main() uses, returning their timings'''
+    results = []
+    events = _timed(results, 'get_events', None, db.get_events, start, end)
+    _timed(
+        results, 'categorise_events', len(events),
+        autotoggl.categorise_events, events, config.classifiers)
+    compressed = _timed(
+        results, 'compress_events', len(events),
+        autotoggl.compress_events, events, config)
+    _timed(
+        results, 'build_project_dict', len(compressed),
+        autotoggl.build_project_dict, compressed)
+    _timed(
+        results, 'render_events', len(compressed),
+        render.render_events, compressed, file=preview)
+    return results
+
+
+def run_batch(db, config, start, end):
+    '''The EventBatch equivalents of get, categorise and compress'''
+    results = []
+    batch = _timed(
+        results, 'get_event_batch', None, db.get_event_batch, start, end)
+    _timed(
+        results, 'categorise_events', len(batch),
+        autotoggl.categorise_events, batch, config.classifiers)
+    _timed(
+        results, 'compress_events', len(batch),
+        autotoggl.compress_events, batch, config)
+    return results
+
+
+def _fastest(runs):
+    '''Keep the fastest of several repeats for each stage'''
+    best = {}
+    for run in runs:
+        for r in run:
+            if r['stage'] not in best or r['seconds'] < best[r['stage']]['seconds']:
+                best[r['stage']] = r
+    return [best[r['stage']] for r in runs[0]]
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(rows, repeat=3, seed=0, directory=None) -> list:
+    directory = directory or tempfile.gettempdir()
+    path = os.path.join(directory, 'autotoggl-pipeline-{}.db'.format(rows))
+    preview = os.path.join(directory, 'autotoggl-pipeline.html')
+    config = get_config()
+
+    t = time.perf_counter()
+    first, last = build_database(path, rows, seed)
+    generated = time.perf_counter() - t
+
+    start = datetime.datetime.fromtimestamp(first)
+    end = datetime.datetime.fromtimestamp(last + 1)
+
+    results = [{
+        'rows': rows, 'path': 'setup', 'stage': 'build_database',
+        'seconds': generated, 'items_in': None, 'items_out': rows,
+    }]
+    with autotoggl.DatabaseManager(filename=path) as db:
+        for name, run in [
+                ('events', lambda: run_events(db, config, start, end, preview)),
+                ('batch', lambda: run_batch(db, config, start, end))]:
+            for r in _fastest([run() for _ in range(repeat)]):
+                r.update(rows=rows, path=name)
+                results.append(r)
+
+    os.remove(path)
+    if os.path.exists(preview):
+        os.remove(preview)
+    return results
+
+
+def compare(results, baseline):
+    '''Print the ratio of each stage timing to the same stage in baseline'''
+    previous = {
+        (r['rows'], r['path'], r['stage']): r['seconds']
+        for r in baseline['results']}
+    print('{:>9}  {:7} {:20} {:>10} {:>10} {:>7}'.format(
+        'rows', 'path', 'stage', 'before', 'after', 'ratio'))
+    for r in results['results']:
+        before = previous.get((r['rows'], r['path'], r['stage']))
+        if before is None:
+            continue
+        print('{:>9}  {:7} {:20} {:>9.3f}s {:>9.3f}s {:>6.2f}x'.format(
+            r['rows'], r['path'], r['stage'], before, r['seconds'],
+            before / r['seconds'] if r['seconds'] else float('inf')))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write results to this JSON file')
+    parser.add_argument(
+        '--compare', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    autotoggl.logger.setLevel(logging.WARNING)
+
+    results = {
+        'commit': _commit(),
+        'timestamp': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': vectorized.available(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': [],
+    }
+    for rows in args.rows:
+        print('Benchmarking {} rows...'.format(rows))
+        for r in benchmark(rows, args.repeat, args.seed):
+            results['results'].append(r)
+            print('  {:7} {:20} {:9.3f}s'.format(
+                r['path'], r['stage'], r['seconds']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
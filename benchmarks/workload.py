@@ -0,0 +1,206 @@
+'''
+Seeded generator of realistic toggl.db workloads.
+
+Window titles follow a Zipf-like distribution over a fixed vocabulary,
+so a few titles make up most events, as in real usage. Focus changes
+are clustered into working sessions separated by idle, lock and
+overnight logoff system events.
+
+Usage:
+    python -m benchmarks.workload --rows 1000000 --path /tmp/toggl.db
+'''
+import contextlib
+import datetime
+import io
+import logging
+import os
+import random
+
+from argparse import ArgumentParser
+
+import autotoggl.autotoggl as autotoggl
+
+from autotoggl.config import Config
+
+
+FIRST_EVENT = datetime.datetime(2018, 1, 1, 9)
+
+PROJECTS = ['auto-toggl', 'gdbackup', 'gassistant', 'website', 'notes']
+FILES = [
+    'autotoggl.py', 'config.py', 'api.py', 'render.py', 'util.py',
+    'README.md', 'setup.py', 'test_local.py', 'models.py', 'views.py',
+]
+SITES = [
+    'reddit: the front page of the internet', 'Google', 'Politics',
+    'StarCraft on Reddit', 'Duolingo', 'Netflix', 'BBC News',
+    'BBC iPlayer - Requiem - Series 1: Episode 1', 'GitHub', 'Stack Overflow',
+]
+OTHER = [
+    ('powershell', 'Windows Powershell'),
+    ('explorer', 'C:\\some\\path'),
+    ('slack', 'Slack - general'),
+]
+
+DEFINITIONS = [
+    {
+        'process': 'sublime_text',
+        'project_pattern': '.*\\((.*?)\\) - Sublime Text.*',
+        'alias': {'gassistant': 'Home Assistant'},
+        'description_pattern': [
+            '.*?([\\w\\d\\-]+\\.[\\w\\d\\-]+) .*?\\(.*?\\) - Sublime Text.*'
+        ],
+        'tag_pattern': [
+            '.*?[\\w\\d\\-]+\\.([\\w\\d\\-]+) .*?\\(.*?\\) - Sublime Text.*'
+        ],
+    },
+    {
+        'process': 'studio64',
+        'project_pattern': '(.*?) - \\[.*\\].*',
+        'description_pattern': ['.*? - \\[.*?\\] - (.*?) - .*'],
+        'tags': ['android', 'dev'],
+    },
+    {
+        'process': 'chrome',
+        'tags': ['chrome'],
+        'projects': [
+            {
+                'project_title': 'Duolingo',
+                'description': 'German practice',
+                'tags': ['language'],
+                'window_contains': ['duolingo'],
+            },
+            {
+                'project_title': 'Procrastination',
+                'description': '_',
+                'window_contains': ['reddit', 'netflix', 'iplayer'],
+            },
+        ],
+    },
+    {
+        'process': 'powershell',
+        'project_title': 'Terminal',
+    },
+]
+
+# Pairs of system events which bracket a period away from the computer
+SYSTEM_GAPS = [
+    ('System.Idle', 'System.UnIdle', 300, 1800),
+    ('System.SessionLock', 'System.SessionUnlock', 600, 3600),
+]
+
+
+def vocabulary():
+    '''All (process, title) pairs, most common first'''
+    titles = []
+    for n, f in enumerate(FILES):
+        for p in PROJECTS:
+            titles.append((
+                'sublime_text',
+                '/{p}/{f} ({p}) - Sublime Text'.format(p=p, f=f)))
+        titles.append((
+            'studio64',
+            '{} - [/path/to/project] - File{}.java - Android Studio'
+            .format(PROJECTS[n % len(PROJECTS)], n)))
+    for s in SITES:
+        titles.append(('chrome', s))
+    titles += OTHER
+    return titles
+
+
+def generate_rows(rows, seed=0):
+    '''
+    Yield (process_name, window_title, start, consumed) rows in order
+    of occurrence. Rows more than a day before the last are consumed.
+    '''
+    rng = random.Random(seed)
+    titles = vocabulary()
+    rng.shuffle(titles)
+    weights = [1 / (n + 1) for n in range(len(titles))]
+
+    start = int(FIRST_EVENT.timestamp())
+    session_remaining = 0
+    n = 0
+    while n < rows:
+        if session_remaining <= 0:
+            # Overnight logoff, then the next day starts at about 9am
+            yield 'System.SessionLogoff', autotoggl.EVENT_SYSTEM, start, True
+            n += 1
+            day = datetime.datetime.fromtimestamp(start).date()
+            start = int(datetime.datetime(
+                day.year, day.month, day.day, 9).timestamp()) + 86400
+            start += rng.randint(0, 3600)
+            session_remaining = rng.randint(200, 1200)
+            continue
+
+        if rng.random() < 0.01:
+            enter, leave, shortest, longest = rng.choice(SYSTEM_GAPS)
+            yield enter, autotoggl.EVENT_SYSTEM, start, True
+            start += rng.randint(shortest, longest)
+            yield leave, autotoggl.EVENT_SYSTEM, start, True
+            n += 2
+            continue
+
+        process, title = rng.choices(titles, weights)[0]
+        yield process, title, start, True
+        n += 1
+        session_remaining -= 1
+
+        # Mostly quick switches with occasional long stretches of focus
+        start += int(rng.lognormvariate(3.5, 1.3)) + 1
+
+
+def get_config(**kwargs) -> Config:
+    '''Config that classifies most of the generated vocabulary'''
+    data = {
+        'api_key': 'benchmark',
+        'default_workspace': 'benchmark',
+        'project_definitions': DEFINITIONS,
+    }
+    data.update(kwargs)
+
+    # Config prints itself when loaded
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Config(clargs={}, json_data=data)
+
+
+def build_database(path, rows, seed=0):
+    '''
+    Write a database of `rows` events to path. Returns the start and
+    end timestamps of the generated events.
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+
+    with autotoggl.DatabaseManager(filename=path) as db:
+        with db.conn:
+            db.exec_many(
+                '''INSERT INTO toggl VALUES (?, ?, ?, ?)''',
+                generate_rows(rows, seed))
+        first, last = db.exec(
+            '''SELECT MIN(start), MAX(start) FROM toggl''').fetchone()
+
+        # Leave the final day pending, as if it had not been submitted
+        db.exec(
+            '''UPDATE toggl SET consumed=0 WHERE start>?''',
+            (last - 86400,))
+    return first, last
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--path', default='/tmp/autotoggl-workload.db')
+    args = parser.parse_args()
+
+    autotoggl.logger.setLevel(logging.WARNING)
+    first, last = build_database(args.path, args.rows, args.seed)
+    print('Wrote {} rows from {} to {} into {}'.format(
+        args.rows,
+        datetime.datetime.fromtimestamp(first).isoformat(),
+        datetime.datetime.fromtimestamp(last).isoformat(),
+        args.path))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,9 @@ This script is run by python2 in EventGhost
 '''
 
 import eg
+import json
 import os
+import socket
 import sqlite3
 import time
 
@@ -11,6 +13,11 @@ from win32gui import GetForegroundWindow, GetWindowText
 
 DB_PATH = os.path.expanduser('~/autotoggl/toggl.db')
 
+# Events are sent to autotoggl-collector if it is running, which writes
+# them in batches. Otherwise they are written to DB_PATH directly.
+# Must match collector_port in config.json
+COLLECTOR_PORT = 47311
+
 SYSTEM_EVENTS = [
     'System.SessionLock',
     'System.SessionUnlock',
@@ -68,7 +75,8 @@ def _init_db():
 
 def _add(cursor, process_name, window_title):
     print(process_name, window_title)
-    sql = '''INSERT INTO toggl VALUES (?, ?, ?, ?)'''
+    sql = '''INSERT INTO toggl (process_name, window_title, start, consumed)
+             VALUES (?, ?, ?, ?)'''
     cursor.execute(
         sql,
         (
@@ -80,6 +88,30 @@ def _add(cursor, process_name, window_title):
     )
 
 
+def _send(process_name, window_title):
+    event = json.dumps({
+        'process': process_name,
+        'title': window_title,
+        'start': int(time.time()),
+    })
+    s = socket.create_connection(('127.0.0.1', COLLECTOR_PORT), timeout=0.5)
+    try:
+        s.sendall(event + '\n')
+    finally:
+        s.close()
+
+
+def _insert(process_name, window_title):
+    conn, cursor = _init_db()
+    try:
+        _add(cursor, process_name, window_title)
+        conn.commit()
+    except Exception as e:
+        print(e)
+    cursor.close()
+    conn.close()
+
+
 # Main
 event_name = eg.event.string
 
@@ -104,11 +136,8 @@ if PROCESS_WHITELIST and process_name not in PROCESS_WHITELIST:
     # Ignore process that is not whitelisted
     raise SystemExit()
 
-conn, cursor = _init_db()
 try:
-    _add(cursor, process_name, title)
-    conn.commit()
-except Exception as e:
-    print(e)
-cursor.close()
-conn.close()
+    _send(process_name, title)
+except socket.error:
+    # Collector is not running
+    _insert(process_name, title)
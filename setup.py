@@ -10,6 +10,10 @@ setup(
     install_requires=[
         'requests>=2.22.0',
     ],
+    extras_require={
+        # Vectorized compression of EventBatch
+        'numpy': ['numpy'],
+    },
     url='https://beatonma.org/autotoggl',
     packages=[
         'autotoggl',
@@ -17,6 +21,7 @@ setup(
     entry_points={
         'console_scripts': [
             'autotoggl = autotoggl.autotoggl:main',
+            'autotoggl-collector = autotoggl.collector:main',
         ],
     },
     zip_safe=False,
@@ -0,0 +1,165 @@
+import datetime
+import os
+import sqlite3
+import tempfile
+import time
+
+import autotoggl.autotoggl as autotoggl
+
+from autotoggl.collector import Collector, RetentionSchedule, send
+
+from tests import test_common
+from tests.test_common import equal
+
+
+logger = test_common.get_logger(name=__name__)
+
+
+def _count(filename):
+    conn = sqlite3.connect(filename)
+    try:
+        return conn.execute('''SELECT COUNT(*) FROM toggl''').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_collector_flush_size():
+    filename = os.path.join(tempfile.mkdtemp(), 'toggl.db')
+    with Collector(filename, port=0, flush_size=10,
+                   flush_seconds=60) as collector:
+        for x in range(25):
+            send('chrome', 'Google {}'.format(x), start=1000 + x,
+                 port=collector.port, timeout=5)
+
+        # Full batches are written without waiting for flush_seconds.
+        # Each flush takes everything buffered so far, which may be
+        # more than flush_size.
+        equal(_wait_for(lambda: collector.written >= 20), True)
+        equal(collector.flushes <= 2, True)
+        equal(_count(filename), collector.written)
+
+    # Anything left in the buffer is written on stop
+    equal(collector.received, 25)
+    equal(collector.written, 25)
+    equal(_count(filename), 25)
+
+
+def test_collector_flush_seconds():
+    filename = os.path.join(tempfile.mkdtemp(), 'toggl.db')
+    with Collector(filename, port=0, flush_size=100,
+                   flush_seconds=0.05) as collector:
+        send('System.Idle', '__SYS__', port=collector.port, timeout=5)
+        equal(_wait_for(lambda: _count(filename) == 1), True)
+
+        # Invalid events are ignored
+        send('chrome', 'Google', start='never', port=collector.port,
+             timeout=5)
+        time.sleep(0.2)
+        equal(collector.received, 1)
+
+    conn = sqlite3.connect(filename)
+    row = conn.execute('''SELECT * FROM toggl''').fetchone()
+    conn.close()
+    equal(row[0], 'System.Idle')
+    equal(abs(row[2] - time.time()) < 60, True)
+    equal(row[3], 0)
+
+
+def test_collector_not_running():
+    try:
+        send('chrome', 'Google', port=1)
+    except OSError:
+        return
+    raise AssertionError('Expected OSError when collector is not running')
+
+
+def test_collector_database_unavailable():
+    '''The collector refuses to start if it cannot open the database'''
+    # A directory cannot be opened as a database
+    filename = tempfile.mkdtemp()
+    collector = Collector(filename, port=0)
+    port = collector.port
+    try:
+        collector.start()
+    except sqlite3.Error:
+        pass
+    else:
+        collector.stop()
+        raise AssertionError('Expected sqlite3.Error for {}'.format(filename))
+
+    # Nothing is listening, so clients fall back to writing directly
+    try:
+        send('chrome', 'Google', port=port, timeout=5)
+    except OSError:
+        return
+    raise AssertionError('Expected OSError once the collector refused to start')
+
+
+def test_retention_schedule():
+    filename = os.path.join(tempfile.mkdtemp(), 'toggl.db')
+    now = datetime.datetime(2018, 6, 12, 9).timestamp()
+    old = int(now) - 10 * 86400
+
+    clock = [now]
+    retention = RetentionSchedule(
+        days=7, chunk_size=100, vacuum_pages=5, interval_seconds=60,
+        clock=lambda: clock[0])
+
+    with autotoggl.DatabaseManager(filename=filename) as db:
+        with db.conn:
+            db.exec_many(
+                '''INSERT INTO toggl VALUES (?, ?, ?, ?)''',
+                [('chrome', 'x' * 200, old + x, x < 950) for x in range(1000)]
+                + [('chrome', 'Google', int(now), True)])
+
+        # Each slice deletes one chunk, then frees a few pages at a time
+        slices = 1
+        while retention.run_slice(db):
+            slices += 1
+        equal(retention.deleted, 950)
+        equal(slices > 10, True)
+        equal(db.exec('''PRAGMA freelist_count''').fetchone()[0], 0)
+
+        # Recent and pending events are kept
+        equal(db.exec('''SELECT COUNT(*) FROM toggl''').fetchone()[0], 51)
+
+        # Nothing more is done until the interval has passed
+        with db.conn:
+            db.exec(
+                '''INSERT INTO toggl VALUES (?, ?, ?, ?)''',
+                ('chrome', 'Google', old, True))
+        equal(retention.run_slice(db), False)
+        equal(retention.deleted, 950)
+
+        clock[0] += 60
+        retention.run_slice(db)
+        equal(retention.deleted, 951)
+
+
+def test_collector_runs_retention():
+    filename = os.path.join(tempfile.mkdtemp(), 'toggl.db')
+    old = int(time.time()) - 10 * 86400
+    with autotoggl.DatabaseManager(filename=filename) as db:
+        with db.conn:
+            db.exec_many(
+                '''INSERT INTO toggl VALUES (?, ?, ?, ?)''',
+                [('chrome', 'Google', old + x, True) for x in range(1000)])
+
+    retention = RetentionSchedule(days=7, chunk_size=50)
+    with Collector(filename, port=0, flush_size=1, flush_seconds=60,
+                   retention=retention) as collector:
+        send('chrome', 'Google', port=collector.port, timeout=5)
+
+        # Slices run back to back without waiting for flush_seconds,
+        # and new events are still written
+        equal(_wait_for(lambda: retention.deleted == 1000), True)
+        equal(_wait_for(lambda: collector.written == 1), True)
+
+    equal(_count(filename), 1)
@@ -0,0 +1,257 @@
+'''
+Equivalence tests for compress_events against the original nested-loop
+implementation, using randomized event streams.
+'''
+import datetime
+import os
+import random
+import tempfile
+
+import autotoggl.autotoggl as autotoggl
+
+from autotoggl import vectorized
+from autotoggl.config import ClassifierResult
+from autotoggl.metrics import Metrics
+
+from tests import test_common
+from tests.test_common import equal
+
+
+logger = test_common.get_logger(__name__)
+
+PROCESSES = [
+    ('chrome', ['reddit', 'Google', 'Politics', 'Netflix']),
+    ('sublime_text', ['a.py (proj) - Sublime Text', 'b.py (proj) - Sublime Text']),
+    ('studio64', ['App - [/path] - File.java - Android Studio']),
+    ('explorer', ['C:\\some\\path']),
+]
+SYSTEM_PROCESSES = [
+    'System.Idle',
+    'System.UnIdle',
+    'System.SessionLock',
+    'System.SessionUnlock',
+]
+PROJECTS = [None, 'Casual', 'auto-toggl', 'Android']
+
+
+def reference_compress_events(events, config):
+    '''
+    The original O(n^2) implementation of compress_events, kept here as
+    the reference behaviour.
+    '''
+    events.sort(key=lambda x: x.start)
+
+    for a, b in zip(events[:-1], events[1:]):
+        a.duration = b.start - a.start
+
+    for n, e in enumerate(events):
+        if (e.duration < config.minimum_event_seconds
+                or e.title == autotoggl.EVENT_SYSTEM):
+            e.duration = 0
+            continue
+
+        if not e.project:
+            continue
+
+        for o in events[n+1:]:
+            if o.title == autotoggl.EVENT_SYSTEM:
+                break
+
+            if o.duration < config.minimum_event_seconds:
+                e.merge(o)
+
+            elif e.title == o.title:
+                e.merge(o)
+
+            elif not o.project:
+                e.merge(o)
+
+            else:
+                break
+
+    return list(filter(lambda x: x.duration and x.project, events))
+
+
+def generate_random_events(rng, count):
+    '''
+    Build a list of event kwargs with a mix of short, long, repeated,
+    unassigned and system events.
+    '''
+    events = []
+    start = 1528790400
+    for n in range(count):
+        if rng.random() < 0.08:
+            process = rng.choice(SYSTEM_PROCESSES)
+            title = autotoggl.EVENT_SYSTEM
+            project = None
+        else:
+            process, titles = rng.choice(PROCESSES)
+            title = rng.choice(titles)
+            project = rng.choice(PROJECTS)
+
+        events.append({
+            'id': n + 1,
+            'process': process,
+            'title': title,
+            'project': project,
+            'start': start,
+        })
+        start += rng.choice([0, 5, 30, 59, 60, 61, 120, 900, 3600])
+
+    # Shuffle so that sorting is exercised too
+    rng.shuffle(events)
+    return events
+
+
+def _summarise(events):
+    return [(e.id, e.start, e.duration, e.merged) for e in events]
+
+
+def test_compress_events_equivalence():
+    config = test_common.get_test_config()
+    rng = random.Random(1528790400)
+
+    for trial in range(300):
+        config.minimum_event_seconds = rng.choice([0, 1, 30, 60, 600])
+        data = generate_random_events(rng, rng.randint(0, 120))
+
+        expected = reference_compress_events(
+            [autotoggl.Event(**x) for x in data], config)
+        actual = autotoggl.compress_events(
+            [autotoggl.Event(**x) for x in data], config)
+
+        assert _summarise(actual) == _summarise(expected), (
+            'trial {}, minimum_event_seconds={}'
+            .format(trial, config.minimum_event_seconds))
+
+    equal(trial + 1, 300, comment='Randomized streams were equivalent')
+
+
+def test_compress_events_equivalence_large():
+    '''
+    A single long stream, similar to a multi-week catch-up
+    '''
+    config = test_common.get_test_config()
+    rng = random.Random(60)
+    data = generate_random_events(rng, 5000)
+
+    expected = reference_compress_events(
+        [autotoggl.Event(**x) for x in data], config)
+    actual = autotoggl.compress_events(
+        [autotoggl.Event(**x) for x in data], config)
+
+    equal(len(actual), len(expected))
+    assert _summarise(actual) == _summarise(expected)
+
+
+def _batch(data):
+    batch = autotoggl.EventBatch()
+    for x in data:
+        batch.append(x['id'], x['process'], x['title'], x['start'])
+    batch.results = [
+        ClassifierResult(project=x['project']) if x['project'] else None
+        for x in data]
+    return batch
+
+
+def test_compress_event_batch():
+    '''
+    compress_events should give the same results for an EventBatch as
+    for a list of Event objects, with or without NumPy
+    '''
+    config = test_common.get_test_config()
+    rng = random.Random(8)
+    numpy = vectorized.np
+
+    for trial in range(200):
+        config.minimum_event_seconds = rng.choice([0, 1, 30, 60, 600])
+        data = generate_random_events(rng, rng.randint(0, 200))
+
+        expected = _summarise(autotoggl.compress_events(
+            [autotoggl.Event(**x) for x in data], config))
+
+        actual = autotoggl.compress_events(_batch(data), config)
+        assert _summarise(actual) == expected, 'trial {}'.format(trial)
+
+        # Pure-Python fallback
+        vectorized.np = None
+        try:
+            actual = autotoggl.compress_events(_batch(data), config)
+        finally:
+            vectorized.np = numpy
+        assert _summarise(actual) == expected, 'trial {}'.format(trial)
+
+    equal(trial + 1, 200, comment='Batches were equivalent')
+
+
+def test_catchup_event_batch():
+    '''
+    A catch-up run compresses each range with NumPy one day at a time,
+    with the same results as streaming Event objects without it
+    '''
+    rng = random.Random(12)
+    data = sorted(generate_random_events(rng, 2000), key=lambda x: x['id'])
+    filename = os.path.join(tempfile.mkdtemp(), 'toggl.db')
+
+    # An event still open when a day ends, and another of the same
+    # activity starting exactly where the next day begins
+    boundary = int((datetime.datetime.fromtimestamp(
+        data[len(data) // 2]['start']).replace(
+            hour=3, minute=0, second=0)
+        + datetime.timedelta(days=1)).timestamp())
+    for start in (boundary - 60, boundary):
+        data.append({
+            'id': len(data) + 1,
+            'process': 'sublime_text',
+            'title': 'a.py (proj) - Sublime Text',
+            'start': start,
+        })
+
+    config = test_common.get_test_config()
+    config.catchup = True
+    config.local = True
+    config.showall = True
+    config.date = datetime.datetime.fromtimestamp(
+        max(x['start'] for x in data) + 86400 * 2)
+
+    def catchup():
+        shown = []
+        batches = []
+        print_events = autotoggl.print_events
+        compress_vectorized = autotoggl._compress_batch_vectorized
+
+        def _compress_batch_vectorized(batch, config, final=True):
+            batches.append(len(batch))
+            return compress_vectorized(batch, config, final)
+
+        autotoggl.print_events = lambda events, starts, ends: shown.extend(
+            events)
+        autotoggl._compress_batch_vectorized = _compress_batch_vectorized
+        try:
+            with autotoggl.DatabaseManager(filename=filename) as db:
+                autotoggl.run(db, config, Metrics())
+        finally:
+            autotoggl.print_events = print_events
+            autotoggl._compress_batch_vectorized = compress_vectorized
+        return _summarise(shown), batches
+
+    with autotoggl.DatabaseManager(filename=filename) as db:
+        db.insert_events(
+            (x['process'], x['title'], x['start'], False) for x in data)
+
+    numpy = vectorized.np
+    expected, batches = catchup()
+    if numpy is not None:
+        # No batch holds the whole range
+        equal(len(batches) > 1, True)
+        equal(max(batches) < len(data), True)
+        equal(sum(batches) >= len(data), True)
+
+    vectorized.np = None
+    try:
+        actual, batches = catchup()
+    finally:
+        vectorized.np = numpy
+    equal(batches, [])
+    equal(len(actual) > 0, True)
+    assert actual == expected
@@ -0,0 +1,126 @@
+'''
+The collector writing at a high rate while -catchup reads a long range,
+each with its own connection as they would be in separate processes.
+'''
+import datetime
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import autotoggl.autotoggl as autotoggl
+
+from autotoggl.cache import ClassificationStore
+from autotoggl.collector import Collector
+from autotoggl.metrics import Metrics
+
+from tests import test_common
+from tests.test_common import equal
+
+
+logger = test_common.get_logger(name=__name__)
+
+FIRST = int(datetime.datetime(2018, 6, 12, 9).timestamp())
+ROWS = 5000
+SENT = 500
+
+
+def _populate(filename):
+    with autotoggl.DatabaseManager(filename=filename) as db:
+        with db.conn:
+            db.exec_many(
+                '''INSERT INTO toggl VALUES (?, ?, ?, ?)''',
+                (('chrome', 'Duolingo', FIRST + x * 10, False)
+                 for x in range(ROWS)))
+
+        # A result saved under previous project definitions, which the
+        # catch-up run deletes when it opens its ClassificationStore
+        ClassificationStore(db, 'stale')
+        with db.conn:
+            db.exec(
+                '''INSERT INTO classifier_cache
+                   VALUES ('stale', 'chrome', 'Google', NULL, NULL, NULL)''')
+
+
+def test_write_during_catchup_read():
+    filename = os.path.join(tempfile.mkdtemp(), 'toggl.db')
+    _populate(filename)
+
+    with autotoggl.DatabaseManager(filename=filename) as db:
+        equal(db.exec('''PRAGMA journal_mode''').fetchone()[0], 'wal')
+        equal(db.exec('''PRAGMA synchronous''').fetchone()[0], 1)
+
+    errors = []
+
+    def write(port):
+        # Stream events over one connection as fast as possible. New
+        # events fall inside the range being read.
+        try:
+            with socket.create_connection(('127.0.0.1', port), 10) as s:
+                for x in range(SENT):
+                    event = {
+                        'process': 'sublime_text',
+                        'title': 'autotoggl.py',
+                        'start': FIRST + x * 10 + 5,
+                    }
+                    s.sendall((json.dumps(event) + '\n').encode())
+        except Exception as e:
+            errors.append(e)
+
+    config = test_common.get_test_config()
+    config.catchup = True
+    config.local = True
+    config.date = datetime.datetime(2018, 6, 14)
+    config.minimum_event_seconds = 0
+    metrics = Metrics()
+    read = []
+
+    with Collector(filename, port=0, flush_size=10,
+                   flush_seconds=0.01) as collector:
+        writer = threading.Thread(target=write, args=(collector.port,))
+
+        with autotoggl.DatabaseManager(filename=filename) as db:
+            iter_rows = db._iter_rows
+
+            def slow_iter_rows(start_datetime, end_datetime, chunk_size=0):
+                # Start writing once the read has begun, then read slowly.
+                # Rows are read here whether or not NumPy is installed.
+                for r in iter_rows(start_datetime, end_datetime, 50):
+                    read.append(r)
+                    if len(read) == 1:
+                        writer.start()
+                    elif len(read) % 50 == 0:
+                        time.sleep(0.01)
+                    yield r
+
+            db._iter_rows = slow_iter_rows
+
+            # The whole catch-up run, including the ClassificationStore
+            # it opens before reading
+            autotoggl.run(db, config, metrics)
+            written_during_read = collector.written
+
+        writer.join()
+
+    # The read sees a consistent snapshot taken when it started
+    equal(len(read), ROWS)
+    equal(metrics.stages['get_events'].items_out, ROWS)
+    equal(all(r[1] == 'chrome' for r in read), True)
+
+    # Writes were committed while the read was in progress, rather than
+    # waiting for it to finish
+    equal(written_during_read > 0, True)
+
+    equal(errors, [])
+    equal(collector.failed_writes, 0)
+    equal(collector.written, SENT)
+
+    with autotoggl.DatabaseManager(filename=filename) as db:
+        equal(
+            db.exec('''SELECT COUNT(*) FROM toggl''').fetchone()[0],
+            ROWS + SENT)
+        equal(
+            db.exec('''SELECT COUNT(*) FROM classifier_cache
+                       WHERE config_hash='stale\'''').fetchone()[0], 0)
@@ -1,12 +1,19 @@
 import datetime
 import os
 import random
+import sqlite3
+import threading
+import time
+
+import requests
 
 from datetime import timedelta
 
 import autotoggl.autotoggl as autotoggl
 
-from autotoggl.config import Config
+from autotoggl.api import ApiError, TogglApiInterface
+from autotoggl.cache import ClassificationStore, ClassifierCache
+from autotoggl.config import Classifier, Config, InvalidConfig
 from autotoggl.util import midnight
 
 from autotoggl.render import render_events
@@ -24,6 +31,8 @@ logger = test_common.get_logger(__name__)
 autotoggl.logger = logger
 autotoggl.BASE_DIR = os.path.expanduser('~/autotoggl/test/')
 autotoggl.DB_PATH = os.path.join(autotoggl.BASE_DIR, 'toggl.db')
+autotoggl.PROJECTS_CACHE_FILE = os.path.join(
+    autotoggl.BASE_DIR, 'projects.json')
 
 
 class Bunch:
@@ -207,6 +216,76 @@ def test_categorise_event():
     equal(event.tags, ['android', 'dev'])
 
 
+def test_categorise_events_cache():
+    '''
+    Confirm that categorise_events classifies each distinct
+    (process, title) pair once and applies the result to every event
+    '''
+    config = test_common.get_test_config()
+
+    titles = [
+        ('chrome', 'Duolingo'),
+        ('sublime_text', '/auto-toggl/main.py (auto-toggl) - Sublime Text'),
+        ('powershell', 'Windows Powershell'),
+    ]
+    events = [
+        autotoggl.Event(process=p, title=t) for p, t in titles * 10]
+
+    cache = autotoggl.categorise_events(events, config.defs())
+    equal(cache.misses, 3)
+    equal(cache.hits, 27)
+    equal(events[0].project, 'Duolingo')
+    equal(events[1].project, 'auto-toggl')
+    equal(events[2].project, None)
+    equal(events[1].project, events[4].project)
+
+    # Least recently used entries are evicted once the cache is full
+    cache = ClassifierCache(config.defs(), maxsize=2)
+    autotoggl.categorise_events(events[:3], config.defs(), cache)
+    autotoggl.categorise_events(events[:1], config.defs(), cache)
+    equal(len(cache), 2)
+    equal(cache.misses, 4)
+
+
+def test_classification_store():
+    '''
+    Confirm that classifier results persist between runs and are
+    discarded when the project definitions change
+    '''
+    config = test_common.get_test_config()
+    events = [
+        autotoggl.Event(process='chrome', title='Duolingo'),
+        autotoggl.Event(process='powershell', title='Windows Powershell'),
+    ]
+
+    def categorise(classifier_hash):
+        with autotoggl.DatabaseManager(filename=autotoggl.DB_PATH) as db:
+            store = ClassificationStore(db, classifier_hash)
+
+            # Opening the store must not leave the database locked
+            equal(db.conn.in_transaction, False)
+
+            cache = ClassifierCache(config.defs(), store=store)
+            autotoggl.categorise_events(events, config.defs(), cache)
+            return cache
+
+    cache = categorise(config.classifier_hash)
+    equal(cache.store_hits, 0)
+
+    cache = categorise(config.classifier_hash)
+    equal(cache.store_hits, 2)
+    equal(events[0].project, 'Duolingo')
+    equal(events[0].tags, ['language', 'chrome'])
+
+    # Results stored under the previous definitions are invalidated
+    cache = categorise('changed')
+    equal(cache.store_hits, 0)
+    cache = categorise(config.classifier_hash)
+    equal(cache.store_hits, 0)
+
+    os.remove(autotoggl.DB_PATH)
+
+
 def test_project_definitions():
     '''
     Confirm that Classifier.get() constructs the correct result
@@ -277,6 +356,78 @@ def test_project_definitions():
     equal(result.tags, ['chrome'])
 
 
+def test_window_contains_order():
+    '''
+    Confirm that the combined window_contains matcher respects the
+    configured order of substrings, not their position in the title
+    '''
+    classifier = Classifier({
+        'project_title': 'Casual',
+        'description': '_',
+        'window_contains': ['newsletter', 'reddit', 'news'],
+    })
+
+    equal(classifier.get('Reddit News').description, 'reddit')
+    equal(classifier.get('The Newsletter - reddit').description, 'newsletter')
+    equal(classifier.get('Sky News').description, 'news')
+    equal(classifier.get('Duolingo'), None)
+
+
+def test_window_contains_long_list():
+    '''
+    Confirm that the configured order decides the match in a long
+    window_contains list, and that titles are compared case-insensitively
+    '''
+    contains = ['nomatch{}'.format(x) for x in range(400)]
+    contains[250] = 'firefox'
+    contains[100] = 'private'
+    contains[399] = 'article'
+    classifier = Classifier({
+        'project_title': 'Casual',
+        'description': '_',
+        'window_contains': contains,
+    })
+
+    title = 'Some Article - Mozilla Firefox Private Browsing'
+    equal(classifier.get(title).description, 'private')
+    equal(classifier.get('Some Article - Firefox').description, 'firefox')
+    equal(classifier.get('Some ARTICLE').description, 'article')
+    equal(classifier.get('nomatch'), None)
+
+
+def test_config_invalid_int():
+    '''Confirm that an invalid setting is reported with its own value'''
+    file_config = test_common.get_test_config().as_json()
+    file_config.update(date=None, classifier_cache_size='big')
+    try:
+        Config(clargs={}, json_data=file_config)
+    except InvalidConfig as e:
+        equal(str(e), "classifier_cache_size is invalid: 'big'")
+        return
+    raise AssertionError('Expected InvalidConfig')
+
+
+def test_connection_profile_invalid():
+    '''
+    Journal modes are checked against the same list by the config and by
+    ConnectionProfile, which formats them into a PRAGMA
+    '''
+    file_config = test_common.get_test_config().as_json()
+    file_config.update(date=None, db_journal_mode='WAL2')
+    try:
+        Config(clargs={}, json_data=file_config)
+        raise AssertionError('Expected InvalidConfig')
+    except InvalidConfig as e:
+        equal(str(e), "db_journal_mode is invalid: 'WAL2'")
+
+    equal(autotoggl.ConnectionProfile(journal_mode='WAL').journal_mode, 'WAL')
+    try:
+        autotoggl.ConnectionProfile(journal_mode='WAL2')
+        raise AssertionError('Expected ValueError')
+    except ValueError as e:
+        equal(str(e), 'Unknown journal mode: WAL2')
+
+
 def test_config():
     config = test_common.get_test_config()
     equal(midnight(config.date), midnight(datetime.datetime.today()))
@@ -324,6 +475,45 @@ def test_config():
     return config
 
 
+def test_db_migrations():
+    '''
+    Confirm that a database created without any indexes, as by
+    eg/for_eventghost.py, is upgraded in place
+    '''
+    conn = sqlite3.connect(autotoggl.DB_PATH)
+    conn.execute(
+        '''CREATE TABLE toggl
+           (process_name TEXT NOT NULL,
+           window_title TEXT NOT NULL,
+           start INTEGER NOT NULL,
+           consumed BOOLEAN NOT NULL DEFAULT 0)''')
+    conn.execute(
+        '''INSERT INTO toggl VALUES (?, ?, ?, ?)''',
+        ('chrome', 'beatonma.org', 1528790400, False))
+    conn.commit()
+    conn.close()
+
+    with autotoggl.DatabaseManager(filename=autotoggl.DB_PATH) as db:
+        equal(
+            db.exec('''PRAGMA user_version''').fetchone()[0],
+            len(autotoggl.MIGRATIONS))
+        indexes = [
+            r[0] for r in db.exec(
+                '''SELECT name FROM sqlite_master
+                   WHERE type='index' AND tbl_name='toggl'
+                   ORDER BY name''')]
+        equal(indexes, ['toggl_start', 'toggl_unconsumed'])
+        equal(db.exec('''SELECT COUNT(*) FROM toggl''').fetchone()[0], 1)
+
+    # Opening an up-to-date database again is a no-op
+    with autotoggl.DatabaseManager(filename=autotoggl.DB_PATH) as db:
+        equal(
+            db.exec('''PRAGMA user_version''').fetchone()[0],
+            len(autotoggl.MIGRATIONS))
+
+    os.remove(autotoggl.DB_PATH)
+
+
 def test_db_consume():
     start = datetime.datetime(2015, 6, 12, 9, 0, 0)
     data = [
@@ -357,7 +547,7 @@ def test_db_consume():
     events[-2].merged.append(events[-1].id)
 
     with autotoggl.DatabaseManager(filename=autotoggl.DB_PATH) as db:
-        db.consume(events)
+        equal(db.consume(events), len(events))
 
         # Test DatabaseManager.consume()
         sql = '''SELECT consumed FROM toggl WHERE rowid=?'''
@@ -376,6 +566,378 @@ def test_db_consume():
     os.remove(autotoggl.DB_PATH)
 
 
+def test_db_iter_events():
+    '''
+    Confirm that events are streamed in order of occurrence across
+    chunk boundaries
+    '''
+    start = datetime.datetime(2015, 6, 12, 9, 0, 0)
+    data = [
+        ('chrome', 'beatonma.org', int(start.timestamp()) + x * 60, False)
+        for x in reversed(range(25))
+    ]
+
+    with autotoggl.DatabaseManager(filename=autotoggl.DB_PATH) as db:
+        db.exec_many('''INSERT INTO toggl VALUES (?, ?, ?, ?)''', data)
+
+        events = list(db.iter_events(
+            start, start + timedelta(days=1), chunk_size=4))
+        equal(len(events), 25)
+        starts = [e.start for e in events]
+        equal(starts == sorted(starts), True, comment='Events are in order')
+        equal(events[0].start, int(start.timestamp()))
+
+    os.remove(autotoggl.DB_PATH)
+
+
+def test_db_clean_up():
+    '''Old events are deleted in chunks and their pages are freed'''
+    start = datetime.datetime(2015, 6, 12, 9, 0, 0)
+    data = [
+        (
+            'chrome',
+            'x' * 200,
+            int(start.timestamp()) + x * 60,
+            x % 10 != 0,
+        )
+        for x in range(2000)
+    ]
+
+    with autotoggl.DatabaseManager(filename=autotoggl.DB_PATH) as db:
+        equal(db.exec('''PRAGMA auto_vacuum''').fetchone()[0], 2)
+        with db.conn:
+            db.exec_many('''INSERT INTO toggl VALUES (?, ?, ?, ?)''', data)
+        pages = db.exec('''PRAGMA page_count''').fetchone()[0]
+
+        # Events which have not been consumed are kept
+        deleted = db.clean_up(chunk_size=300, before=start + timedelta(days=7))
+        equal(deleted, 1800)
+        equal(db.exec('''SELECT COUNT(*) FROM toggl''').fetchone()[0], 200)
+        equal(db.exec('''SELECT SUM(consumed) FROM toggl''').fetchone()[0], 0)
+
+        equal(db.exec('''PRAGMA freelist_count''').fetchone()[0], 0)
+        equal(db.exec('''PRAGMA page_count''').fetchone()[0] < pages, True)
+
+        deleted = db.clean_up(
+            chunk_size=300, before=start + timedelta(days=7), all=True)
+        equal(deleted, 200)
+
+    os.remove(autotoggl.DB_PATH)
+
+
+def test_db_normalize():
+    '''
+    An existing database is converted to dictionary tables without
+    changing its events, which are read back with interned strings
+    '''
+    start = datetime.datetime(2015, 6, 12, 9, 0, 0)
+    data = [
+        (
+            ['chrome', 'code', 'slack'][x % 3],
+            'title {}'.format(x % 7),
+            int(start.timestamp()) + x * 60,
+            x < 100,
+        )
+        for x in range(300)
+    ]
+
+    with autotoggl.DatabaseManager(filename=autotoggl.DB_PATH) as db:
+        equal(db.normalized, False)
+        with db.conn:
+            db.exec_many('''INSERT INTO toggl VALUES (?, ?, ?, ?)''', data)
+        before = db.exec(
+            '''SELECT rowid, process_name, window_title, start, consumed
+               FROM toggl ORDER BY rowid''').fetchall()
+
+    with autotoggl.DatabaseManager(
+            filename=autotoggl.DB_PATH, normalize=True) as db:
+        equal(db.normalized, True)
+        equal(db.exec('''SELECT COUNT(*) FROM processes''').fetchone()[0], 3)
+        equal(db.exec('''SELECT COUNT(*) FROM titles''').fetchone()[0], 7)
+        after = db.exec(
+            '''SELECT rowid, process_name, window_title, start, consumed
+               FROM toggl ORDER BY rowid''').fetchall()
+        equal(after == before, True)
+
+        events = db.get_events(start, start + timedelta(days=1))
+        equal(len(events), 300)
+        equal(events[0].process is events[3].process, True)
+        equal(events[0].title is events[7].title, True)
+
+        # Inserts which name their columns go through the view
+        db.insert_events([('vim', 'title 0', int(start.timestamp()), False)])
+        equal(db.exec('''SELECT COUNT(*) FROM processes''').fetchone()[0], 4)
+        equal(db.exec('''SELECT COUNT(*) FROM titles''').fetchone()[0], 7)
+        events = db.get_events(start, start + timedelta(days=1))
+        equal(len(events), 301)
+        equal('vim' in [e.process for e in events], True)
+
+        pending = [e for e in events if not e.consumed][:50]
+        for e in pending:
+            e.consumed = True
+        equal(db.consume(pending), 50)
+        deleted = db.clean_up(chunk_size=40, before=start + timedelta(days=7))
+        equal(deleted, 150)
+        equal(db.exec('''SELECT COUNT(*) FROM toggl''').fetchone()[0], 151)
+
+    # The database stays normalized when opened without normalize
+    with autotoggl.DatabaseManager(filename=autotoggl.DB_PATH) as db:
+        equal(db.normalized, True)
+        equal(len(db.get_events(start, start + timedelta(days=1))), 151)
+
+    os.remove(autotoggl.DB_PATH)
+
+
+def test_catchup_pending_ranges():
+    '''Catching up only reads days which have events left to consume'''
+    day = datetime.datetime(2015, 6, 1, 9, 0, 0)
+
+    # Each day has four events, and days 0, 2, 3 and 5 have one which
+    # has not been consumed
+    pending = [0, 2, 3, 5]
+    data = [
+        (
+            'chrome',
+            'day {}'.format(d),
+            int((day + timedelta(days=d, hours=h)).timestamp()),
+            not (d in pending and h == 3),
+        )
+        for d in range(7)
+        for h in range(4)
+    ]
+
+    with autotoggl.DatabaseManager(filename=autotoggl.DB_PATH) as db:
+        with db.conn:
+            db.exec_many('''INSERT INTO toggl VALUES (?, ?, ?, ?)''', data)
+
+        date_ends = datetime.datetime(2015, 6, 7)
+        equal(
+            db.pending_days(date_ends.replace(hour=3)),
+            [datetime.datetime(2015, 6, d + 1, 3) for d in pending])
+
+        ranges = autotoggl.pending_ranges(db, date_ends)
+        equal(ranges == [
+            (datetime.datetime(2015, 6, 1, 3), datetime.datetime(2015, 6, 2, 3)),
+            (datetime.datetime(2015, 6, 3, 3), datetime.datetime(2015, 6, 5, 3)),
+            (datetime.datetime(2015, 6, 6, 3), datetime.datetime(2015, 6, 7, 3)),
+        ], True)
+
+        events = autotoggl.get_events_until(db, date_ends)
+        equal(
+            sorted(set(e.title for e in events)),
+            ['day {}'.format(d) for d in pending])
+        equal(len(events), 16)
+
+        # Nothing is read once every day has been consumed
+        for e in events:
+            e.consumed = True
+        db.consume(events)
+        equal(autotoggl.get_events_until(db, date_ends), [])
+
+    os.remove(autotoggl.DB_PATH)
+
+
+class FakeInterface:
+    '''
+    Stands in for TogglApiInterface. Any time entry whose description
+    is 'fail' is rejected.
+    '''
+    def __init__(self):
+        self.projects = {'Existing': {'pid': 1, 'wid': 1}}
+        self.created_projects = []
+        self.entries = []
+        self.lock = threading.Lock()
+        self.refreshed = False
+
+    def ensure_projects(self):
+        pass
+
+    def refresh_projects(self):
+        self.refreshed = True
+
+    def create_project(self, project_name):
+        self.created_projects.append(project_name)
+        self.projects[project_name] = {'pid': 2, 'wid': 1}
+
+    def create_time_entry(self, project_id, description, start, duration,
+                          tags=[]):
+        time.sleep(0.01)
+        if description == 'fail':
+            raise ApiError('[error:400] rejected')
+        if description == 'offline':
+            raise requests.ConnectionError('Connection refused')
+        if description == 'crash':
+            raise KeyError(project_id)
+        with self.lock:
+            self.entries.append(start)
+
+
+def test_submit_concurrent():
+    '''
+    Confirm that submit returns the same results whether or not
+    entries are submitted concurrently
+    '''
+    for concurrency in [1, 8]:
+        projects = {
+            'Existing': [
+                autotoggl.Event(
+                    id=n, project='Existing', start=n, duration=60,
+                    description='fail' if n % 5 == 0 else 'ok')
+                for n in range(1, 41)],
+            'New': [
+                autotoggl.Event(
+                    id=100, project='New', start=100, duration=60,
+                    consumed=True),
+                autotoggl.Event(id=101, project='New', start=101, duration=60),
+            ],
+        }
+        interface = FakeInterface()
+        successful, failed = autotoggl.submit(
+            interface, projects, concurrency=concurrency)
+
+        equal(interface.created_projects, ['New'])
+        equal([e.id for e in failed], [5, 10, 15, 20, 25, 30, 35, 40])
+        equal(len(successful), 33)
+        equal(sorted(interface.entries), sorted(e.start for e in successful))
+        equal(all(e.consumed for e in successful), True)
+        equal(any(e.consumed for e in failed), False)
+
+
+def test_submit_unexpected_error():
+    '''
+    Confirm that network errors fail a single entry, and that any other
+    error stops submission without posting entries whose results are
+    never reported
+    '''
+    for concurrency in [1, 4]:
+        projects = {
+            'Existing': [
+                autotoggl.Event(
+                    id=n, project='Existing', start=n, duration=60,
+                    description='offline' if n == 3 else 'ok')
+                for n in range(1, 41)],
+        }
+        interface = FakeInterface()
+        completed = []
+        successful, failed = autotoggl.submit(
+            interface, projects, concurrency=concurrency,
+            on_complete=lambda e, err: completed.append(e))
+        equal([e.id for e in failed], [3])
+        equal(len(successful), 39)
+        equal(len(completed), 40)
+
+        projects['Existing'][9].description = 'crash'
+        for e in projects['Existing']:
+            e.consumed = False
+        interface = FakeInterface()
+        completed = []
+        try:
+            autotoggl.submit(
+                interface, projects, concurrency=concurrency,
+                on_complete=lambda e, err: completed.append(e))
+            raise AssertionError('KeyError was not raised')
+        except KeyError:
+            pass
+
+        # Every entry that was posted has been reported
+        equal(len(interface.entries) < 39, True)
+        equal(
+            sorted(interface.entries),
+            sorted(e.start for e in completed if e.id != 3))
+
+
+def test_outbox():
+    '''
+    Confirm that outbox state is committed as each submission completes
+    and that failed entries are retried after a backoff
+    '''
+    start = datetime.datetime(2015, 6, 12, 9, 0, 0)
+    data = [
+        ('chrome', 'beatonma.org', int(start.timestamp()) + x * 600, False)
+        for x in range(4)
+    ]
+
+    with autotoggl.DatabaseManager(filename=autotoggl.DB_PATH) as db:
+        db.exec_many('''INSERT INTO toggl VALUES (?, ?, ?, ?)''', data)
+
+        events = [
+            autotoggl.Event(
+                id=1, project='Existing', start=data[0][2], duration=1200,
+                description='ok'),
+            autotoggl.Event(
+                id=3, project='Existing', start=data[2][2], duration=1200,
+                description='fail'),
+        ]
+        events[0].merged.append(2)
+        events[1].merged.append(4)
+
+        outbox = autotoggl.Outbox(db, retry_seconds=60)
+        outbox.plan(events)
+        equal(outbox.counts(), {'pending': 2})
+
+        successful, failed = autotoggl.submit(
+            FakeInterface(), {'Existing': events}, on_complete=outbox.record)
+        equal(outbox.counts(), {'submitted': 1, 'failed': 1})
+
+        consumed = [
+            r[0] for r in db.exec(
+                '''SELECT consumed FROM toggl ORDER BY rowid''')]
+        equal(consumed == [1, 1, 0, 0], True, data=consumed)
+
+        # Failed entries wait for the backoff before they are due
+        equal(outbox.due(), [])
+        due = outbox.due(now=time.time() + 61)
+        equal([e.id for e in due], [3])
+        equal(due[0].merged, [4])
+        equal(due[0].duration, 1200)
+
+        # Planning the same entries again does not resubmit successes
+        outbox.plan(events)
+        equal(outbox.counts(), {'submitted': 1, 'pending': 1})
+        equal([e.id for e in outbox.due()], [3])
+
+    os.remove(autotoggl.DB_PATH)
+
+
+def test_project_cache():
+    '''
+    Confirm that workspaces and projects are reused from the cache file
+    until it expires
+    '''
+    config = test_common.get_test_config()
+    cache_file = os.path.join(autotoggl.BASE_DIR, 'projects.json')
+
+    interface = TogglApiInterface(config, cache_file=cache_file)
+    interface._cache_workspaces([{'id': 10, 'name': TEST_WORKSPACE}])
+    interface._cache_projects([{'id': 20, 'wid': 10, 'name': 'Existing'}])
+    interface.save_cache()
+
+    # A fresh cache is used without making any requests
+    interface = TogglApiInterface(config, cache_file=cache_file)
+    interface.session = None
+    interface.ensure_projects()
+    equal(interface.projects, {'Existing': {'pid': 20, 'wid': 10}})
+    equal(interface.default_workspace, 10)
+    equal(interface.refreshed, False)
+
+    # A cache saved for another server or account is ignored
+    config.api_base = 'http://127.0.0.1:8000/api/v8/'
+    interface = TogglApiInterface(config, cache_file=cache_file)
+    equal(interface.load_cache(), False)
+    config.api_base = None
+    config.api_key = 'another key'
+    interface = TogglApiInterface(config, cache_file=cache_file)
+    equal(interface.load_cache(), False)
+    config.api_key = TEST_API_KEY
+
+    # An expired cache is ignored
+    config.project_cache_ttl = -1
+    interface = TogglApiInterface(config, cache_file=cache_file)
+    equal(interface.load_cache(), False)
+
+    os.remove(cache_file)
+
+
 def test_get_total_duration():
     events = [
         autotoggl.Event(duration=20),
@@ -0,0 +1,95 @@
+import json
+import os
+import tempfile
+
+from autotoggl.metrics import Metrics
+
+from tests import test_common
+from tests.test_common import equal
+
+
+logger = test_common.get_logger(name=__name__)
+
+
+class FakeClock:
+    '''Clock which only moves when told to'''
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def test_metrics_nested_stages():
+    clock = FakeClock()
+    metrics = Metrics(clock=clock)
+
+    with metrics.stage('outer', items_in=3) as outer:
+        clock.advance(1)
+        with metrics.stage('inner'):
+            clock.advance(2)
+        clock.advance(1)
+        outer.items_out = 2
+
+    # Time spent in the nested stage is not charged to the outer stage
+    equal(metrics.stages['outer'].seconds, 2)
+    equal(metrics.stages['inner'].seconds, 2)
+    equal(metrics.stages['outer'].items_in, 3)
+    equal(metrics.stages['outer'].items_out, 2)
+    equal(metrics.as_json()['seconds'], 4)
+
+
+def test_metrics_chained_generators():
+    '''Stages which stream into each other are timed separately'''
+    clock = FakeClock()
+    metrics = Metrics(clock=clock)
+
+    def source():
+        for x in range(10):
+            clock.advance(1)
+            yield x
+
+    def evens(items):
+        for x in items:
+            clock.advance(0.5)
+            if x % 2 == 0:
+                yield x
+
+    items = metrics.iterate('source', source())
+    items = list(metrics.iterate('evens', evens(items), source='source'))
+
+    equal(items, [0, 2, 4, 6, 8])
+    data = metrics.as_json()['stages']
+    equal(data['source']['seconds'], 10)
+    equal(data['evens']['seconds'], 5)
+    equal(data['evens']['items_in'], 10)
+    equal(data['evens']['items_out'], 5)
+
+
+def test_metrics_write():
+    metrics = Metrics()
+    with metrics.stage('submit', items_in=2):
+        metrics.count('api_requests', 2)
+        metrics.count('api_bytes_sent', 100)
+
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'metrics.json')
+    metrics.write(filename)
+    with open(filename) as f:
+        data = json.load(f)
+    equal(data['counters'], {'api_requests': 2, 'api_bytes_sent': 100})
+    equal(data['stages']['submit']['items_in'], 2)
+
+    filename = os.path.join(directory, 'autotoggl.prom')
+    metrics.write(filename)
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    equal('autotoggl_api_requests 2' in lines, True)
+    equal('autotoggl_stage_items_in{stage="submit"} 2' in lines, True)
+    equal('# TYPE autotoggl_stage_seconds gauge' in lines, True)
+
+    # Nothing is left behind by the atomic replace
+    equal(sorted(os.listdir(directory)), ['autotoggl.prom', 'metrics.json'])
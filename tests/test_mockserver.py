@@ -0,0 +1,191 @@
+'''
+Submission tests against autotoggl.mockserver, which need no
+credentials or network access.
+'''
+import datetime
+import json
+import os
+import tempfile
+
+import autotoggl.autotoggl as autotoggl
+
+from autotoggl.api import TogglApiInterface
+from autotoggl.metrics import Metrics
+from autotoggl.mockserver import MockTogglServer
+
+from tests import test_common
+from tests.test_common import equal
+from tests.test_credentials import TEST_WORKSPACE
+
+
+logger = test_common.get_logger(name=__name__)
+autotoggl.BASE_DIR = os.path.expanduser('~/autotoggl/test/')
+
+# Computed from the real BASE_DIR on import, so it must be set as well
+autotoggl.PROJECTS_CACHE_FILE = os.path.join(
+    autotoggl.BASE_DIR, 'projects.json')
+
+
+def _config(server, **kwargs):
+    config = test_common.get_test_config()
+    config.api_base = server.url
+    config.api_requests_per_second = 100
+    config.api_burst = 10
+    for key, value in kwargs.items():
+        setattr(config, key, value)
+    return config
+
+
+def _server(**kwargs):
+    return MockTogglServer(
+        workspaces=[{'id': 1, 'name': TEST_WORKSPACE}], **kwargs)
+
+
+def _projects(n=20):
+    start = int(datetime.datetime(2018, 6, 12, 9).timestamp())
+    return {
+        'auto-toggl': [
+            autotoggl.Event(
+                id=x, project='auto-toggl', start=start + x * 600,
+                duration=600, description='entry {}'.format(x),
+                tags=['dev'])
+            for x in range(n)],
+    }
+
+
+def test_mock_submit():
+    with _server(latency=0.01) as server:
+        interface = TogglApiInterface(_config(server))
+        successful, failed = autotoggl.submit(
+            interface, _projects(), concurrency=4)
+
+        equal(len(successful), 20)
+        equal(len(failed), 0)
+        equal(len(server.time_entries), 20)
+        equal([p['name'] for p in server.projects], ['auto-toggl'])
+        equal(interface.default_workspace, 1)
+
+        # Entries can be found again by reconciliation
+        remote = interface.get_time_entries(
+            min(e.start for e in successful),
+            max(e.start for e in successful) + 1)
+        equal(len(remote), 20)
+
+
+def test_mock_rate_limit():
+    '''Requests rejected with HTTP 429 are retried after Retry-After'''
+    with _server(rate_limit=20, burst=2) as server:
+        metrics = Metrics()
+        interface = TogglApiInterface(_config(server), metrics=metrics)
+        interface.limiter.rate = 1000
+        interface.limiter.capacity = 1000
+
+        successful, failed = autotoggl.submit(
+            interface, _projects(), concurrency=8)
+
+        equal(len(successful), 20)
+        equal(len(server.time_entries), 20)
+        equal(server.rate_limited > 0, True)
+
+        # Every request and retry is counted by the interface
+        equal(metrics.counters['api_requests'], server.requests)
+        equal(metrics.counters['api_retries'], server.rate_limited)
+        equal(metrics.counters['api_bytes_sent'] > 0, True)
+
+
+def test_mock_failures():
+    with _server(fail_descriptions=['entry 3', 'entry 7']) as server:
+        interface = TogglApiInterface(_config(server))
+        successful, failed = autotoggl.submit(
+            interface, _projects(), concurrency=4)
+
+        equal(sorted(e.id for e in failed), [3, 7])
+        equal(len(successful), 18)
+        equal(len(server.time_entries), 18)
+
+
+def test_mock_run_failure():
+    '''A day with an entry that failed to submit is still pending'''
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'toggl.db')
+    start = int(datetime.datetime(2018, 6, 12, 9).timestamp())
+    rows = [
+        ('sublime_text', 'a.py (auto-toggl) - Sublime Text', start, False),
+        ('chrome', 'Duolingo', start + 1800, False),
+        ('System.SessionLock', autotoggl.EVENT_SYSTEM, start + 3600, False),
+    ]
+
+    cache_file = autotoggl.PROJECTS_CACHE_FILE
+    autotoggl.PROJECTS_CACHE_FILE = os.path.join(directory, 'projects.json')
+    try:
+        with _server(fail_descriptions=['German practice']) as server:
+            config = _config(server, date=datetime.datetime(2018, 6, 12))
+            with autotoggl.DatabaseManager(filename=filename) as db:
+                db.insert_events(rows)
+                autotoggl.run(db, config, Metrics())
+                equal(len(server.time_entries), 1)
+                equal(
+                    db.pending_days(datetime.datetime(2018, 6, 14)),
+                    [datetime.datetime(2018, 6, 12, 3)])
+    finally:
+        autotoggl.PROJECTS_CACHE_FILE = cache_file
+
+
+def test_mock_run():
+    '''The whole run, from stored events to submitted time entries'''
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'toggl.db')
+    start = int(datetime.datetime(2018, 6, 12, 9).timestamp())
+    rows = [
+        ('sublime_text', 'a.py (auto-toggl) - Sublime Text', start, False),
+        ('chrome', 'Duolingo', start + 1800, False),
+        ('sublime_text', 'b.py (auto-toggl) - Sublime Text', start + 3600,
+         False),
+        ('System.SessionLock', autotoggl.EVENT_SYSTEM, start + 5400, False),
+    ]
+
+    cache_file = autotoggl.PROJECTS_CACHE_FILE
+    autotoggl.PROJECTS_CACHE_FILE = os.path.join(directory, 'projects.json')
+    try:
+        with _server() as server:
+            config = _config(server, date=datetime.datetime(2018, 6, 12))
+            metrics = Metrics()
+            with autotoggl.DatabaseManager(filename=filename) as db:
+                db.insert_events(rows)
+                autotoggl.run(db, config, metrics)
+
+            entries = sorted(
+                (e['description'], e['duration'])
+                for e in server.time_entries)
+            equal(entries == [
+                ('German practice', 1800),
+                ('a.py', 1800),
+                ('b.py', 1800),
+            ], True)
+            equal(
+                sorted(p['name'] for p in server.projects),
+                ['Duolingo', 'auto-toggl'])
+            equal(metrics.counters['entries_submitted'], 3)
+
+            # Once every entry has been submitted the whole day is
+            # consumed, including the system event which was not part of
+            # any entry, so catch-up no longer reads it
+            with autotoggl.DatabaseManager(filename=filename) as db:
+                equal(
+                    db.exec('''SELECT COUNT(*) FROM toggl
+                               WHERE consumed=0''').fetchone()[0], 0)
+                equal(db.pending_days(datetime.datetime(2018, 6, 14)), [])
+
+                config.catchup = True
+                config.date = datetime.datetime(2018, 6, 14)
+                try:
+                    autotoggl.run(db, config, Metrics())
+                except SystemExit:
+                    pass
+            equal(len(server.time_entries), 3)
+
+        # The project cache was written to the overridden location
+        with open(autotoggl.PROJECTS_CACHE_FILE) as f:
+            equal(len(json.load(f)['projects']), 2)
+    finally:
+        autotoggl.PROJECTS_CACHE_FILE = cache_file
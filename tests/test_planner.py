@@ -0,0 +1,175 @@
+import datetime
+import os
+import tempfile
+
+import autotoggl.autotoggl as autotoggl
+
+from autotoggl.api import _isoformat
+from autotoggl.metrics import Metrics
+from autotoggl.planner import plan_entries
+from autotoggl.reconcile import reconcile
+
+from tests import test_common
+from tests.test_common import equal
+
+
+logger = test_common.get_logger(name=__name__)
+
+
+def _entries():
+    shared_tags = ['py']
+    return {
+        'auto-toggl': [
+            autotoggl.Event(
+                id=1, start=0, duration=600, description='main.py',
+                tags=shared_tags),
+            autotoggl.Event(
+                id=5, start=660, duration=300, description='main.py',
+                tags=['dev']),
+            autotoggl.Event(
+                id=9, start=1500, duration=300, description='main.py',
+                tags=shared_tags),
+            autotoggl.Event(
+                id=12, start=1800, duration=300, description='util.py'),
+        ],
+        'Casual': [
+            autotoggl.Event(
+                id=3, start=900, duration=300, description='Internetting'),
+        ],
+    }
+
+
+def test_plan_entries():
+    projects = _entries()
+    projects['auto-toggl'][1].merged.extend([6, 7])
+    shared_tags = projects['auto-toggl'][0].tags
+
+    planned, saved = plan_entries(projects, 120)
+    equal(saved, 1)
+
+    entries = planned['auto-toggl']
+    equal([e.id for e in entries], [1, 9, 12])
+    equal(entries[0].duration, 900)
+    equal(entries[0].merged, [5, 6, 7])
+    equal(entries[0].tags, ['py', 'dev'])
+
+    # Tags shared between events are not modified in place
+    equal(shared_tags, ['py'])
+
+    equal([e.id for e in planned['Casual']], [3])
+
+
+def test_plan_entries_tolerance():
+    planned, saved = plan_entries(_entries(), 600)
+    equal(saved, 2)
+    equal([e.id for e in planned['auto-toggl']], [1, 12])
+    equal(planned['auto-toggl'][0].duration, 1200)
+
+    planned, saved = plan_entries(_entries(), 0)
+    equal(saved, 0)
+    equal([e.id for e in planned['auto-toggl']], [1, 5, 9, 12])
+
+
+def test_plan_entries_other_project():
+    '''Entries are not merged across an entry from another project'''
+    projects = {
+        'A': [
+            autotoggl.Event(id=1, start=0, duration=1800, description='a'),
+            autotoggl.Event(id=3, start=3600, duration=1800, description='a'),
+        ],
+        'B': [
+            autotoggl.Event(id=2, start=1800, duration=1800, description='b'),
+        ],
+    }
+
+    planned, saved = plan_entries(projects, 1800)
+    equal(saved, 0)
+    equal([(e.id, e.duration) for e in planned['A']], [(1, 1800), (3, 1800)])
+    equal([e.id for e in planned['B']], [2])
+
+
+def test_plan_entries_deterministic():
+    '''Input order does not affect the result'''
+    projects = _entries()
+    projects['auto-toggl'].reverse()
+
+    planned, saved = plan_entries(projects, 120)
+    equal(saved, 1)
+    equal(
+        [(e.id, e.duration) for e in planned['auto-toggl']],
+        [(1, 900), (9, 300), (12, 300)])
+
+
+def test_preview_matches_plan():
+    '''-showall lists the planned entries, as they will be submitted'''
+    start = int(datetime.datetime(2018, 6, 12, 9).timestamp())
+    title = 'main.py (auto-toggl) - Sublime Text'
+    rows = [
+        ('sublime_text', title, start, False),
+        ('System.Idle', autotoggl.EVENT_SYSTEM, start + 600, False),
+        ('sublime_text', title, start + 900, False),
+        ('chrome', 'Duolingo', start + 1500, False),
+        ('System.SessionLock', autotoggl.EVENT_SYSTEM, start + 1800, False),
+    ]
+
+    filename = os.path.join(tempfile.mkdtemp(), 'toggl.db')
+    config = test_common.get_test_config()
+    config.date = datetime.datetime(2018, 6, 12)
+    config.local = True
+    config.showall = True
+    config.merge_tolerance_seconds = 600
+
+    shown = []
+    print_events = autotoggl.print_events
+    autotoggl.print_events = lambda events, starts, ends: shown.extend(events)
+    try:
+        with autotoggl.DatabaseManager(filename=filename) as db:
+            db.insert_events(rows)
+            autotoggl.run(db, config, Metrics())
+    finally:
+        autotoggl.print_events = print_events
+
+    shown = [(e.project, e.duration) for e in shown if e.project]
+    equal(shown == [('auto-toggl', 1200), ('Duolingo', 300)], True)
+
+
+class RemoteInterface:
+    '''Returns a fixed list of remote time entries'''
+    def __init__(self, remote):
+        self.remote = remote
+        self.projects = {
+            'auto-toggl': {'pid': 20, 'wid': 1},
+            'Casual': {'pid': 30, 'wid': 1},
+        }
+        self.requests = 0
+
+    def get_time_entries(self, start, end):
+        self.requests += 1
+        return self.remote
+
+
+def _remote(event, pid):
+    return {
+        'start': _isoformat(event.start),
+        'duration': event.duration,
+        'pid': pid,
+        'description': event.description,
+    }
+
+
+def test_reconcile():
+    projects = _entries()
+    existing = projects['auto-toggl']
+    interface = RemoteInterface([
+        _remote(existing[0], 20),
+        _remote(existing[2], 20),
+
+        # Same times but a different project
+        _remote(existing[3], 30),
+    ])
+
+    remaining, matched = reconcile(interface, projects)
+    equal(interface.requests, 1)
+    equal([e.id for e in matched], [1, 9])
+    equal([e.id for e in remaining['auto-toggl']], [5, 12])
+    equal([e.id for e in remaining['Casual']], [3])
@@ -0,0 +1,54 @@
+import os
+import pstats
+import tempfile
+
+from autotoggl.metrics import Metrics
+from autotoggl.profiling import Profiler
+
+from tests import test_common
+from tests.test_common import equal
+
+
+logger = test_common.get_logger(name=__name__)
+
+
+def _work(metrics):
+    with metrics.stage('allocate'):
+        data = [str(x) * 10 for x in range(10000)]
+    items = list(metrics.iterate('stream', iter(data)))
+    return items
+
+
+def test_profiler_all():
+    directory = tempfile.mkdtemp()
+    metrics = Metrics()
+    profiler = Profiler('all', directory)
+    metrics.on_stage_end = profiler.snapshot
+
+    with profiler:
+        _work(metrics)
+
+    equal(sorted(os.listdir(directory)), sorted([
+        os.path.basename(profiler.stats_file),
+        os.path.basename(profiler.allocations_file)]))
+
+    stats = pstats.Stats(profiler.stats_file)
+    equal(any(f[2] == '_work' for f in stats.stats), True)
+
+    with open(profiler.allocations_file) as f:
+        report = f.read()
+
+    # A snapshot is taken at the end of each stage
+    labels = [
+        line.split(':')[0].strip('= ')
+        for line in report.splitlines() if line.startswith('===')]
+    equal(labels == ['start', 'allocate', 'stream', 'end'], True)
+    equal('test_profiling.py' in report, True)
+
+
+def test_profiler_cpu_only():
+    directory = tempfile.mkdtemp()
+    with Profiler('cpu', directory) as profiler:
+        _work(Metrics())
+
+    equal(os.listdir(directory), [os.path.basename(profiler.stats_file)])
@@ -0,0 +1,68 @@
+from autotoggl.api import _retry_after
+from autotoggl.ratelimit import TokenBucket
+
+from tests import test_common
+from tests.test_common import equal
+
+
+logger = test_common.get_logger(name=__name__)
+
+
+class FakeClock:
+    '''Clock for TokenBucket which only moves when sleep() is called'''
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class FakeResponse:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+def test_token_bucket_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=2, clock=clock, sleep=clock.sleep)
+
+    # Burst is allowed up to capacity without waiting
+    equal(bucket.acquire(), 0)
+    equal(bucket.acquire(), 0)
+
+    # Subsequent requests are paced at the given rate
+    equal(bucket.acquire(), 0.5)
+    equal(bucket.acquire(), 0.5)
+    equal(clock.now, 1.0)
+
+
+def test_token_bucket_backoff():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=10, capacity=5, clock=clock, sleep=clock.sleep)
+
+    bucket.backoff(3)
+    equal(bucket.acquire(), 3)
+
+    # Any burst was drained by the backoff and the rate was halved
+    equal(bucket.rate, 5)
+    equal(bucket.acquire(), 0.2)
+
+    # Successful requests recover the rate up to its maximum
+    for _ in range(100):
+        bucket.succeeded()
+    equal(bucket.rate, 10)
+
+
+def test_retry_after():
+    equal(_retry_after(FakeResponse({'Retry-After': '7'})), 7.0)
+    equal(_retry_after(FakeResponse({}), default=2), 2)
+    equal(_retry_after(FakeResponse({'Retry-After': 'soon'}), default=4), 4)
+    equal(
+        _retry_after(FakeResponse(
+            {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})),
+        0.0)
@@ -0,0 +1,83 @@
+import os
+import tempfile
+
+import autotoggl.autotoggl as autotoggl
+
+from autotoggl.tracing import QueryTracer
+
+from tests import test_common
+from tests.test_common import equal
+
+
+logger = test_common.get_logger(name=__name__)
+
+INSERT = '''INSERT INTO toggl VALUES (?, ?, ?, ?)'''
+
+
+class FakeClock:
+    '''Clock which advances by a fixed step each time it is read'''
+    def __init__(self, step):
+        self.now = 0.0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+def _database(tracer):
+    filename = os.path.join(tempfile.mkdtemp(), 'toggl.db')
+    return autotoggl.DatabaseManager(filename=filename, tracer=tracer)
+
+
+def test_query_tracer_statements():
+    tracer = QueryTracer()
+    with _database(tracer) as db:
+        rows = (('chrome', 'Google', 1000 + x, False) for x in range(50))
+        with db.conn:
+            db.exec_many(INSERT, rows)
+        for x in range(3):
+            db.exec('''SELECT * FROM toggl WHERE start=?''', (1000 + x,))
+        events = db.get_events(
+            autotoggl.datetime.datetime.fromtimestamp(1000),
+            autotoggl.datetime.datetime.fromtimestamp(1100))
+        equal(len(events), 50)
+        for e in events:
+            e.consumed = True
+        equal(db.consume(events), 50)
+
+    # Parameter sets from a generator are counted as they are used
+    insert = tracer.statements[INSERT]
+    equal(insert.calls, 1)
+    equal(insert.parameters, 50)
+    equal(insert.rows, 50)
+
+    select = tracer.statements['''SELECT * FROM toggl WHERE start=?''']
+    equal(select.calls, 3)
+    equal(select.parameters, 3)
+
+    update = [s for s in tracer.statements.values()
+              if s.sql.startswith('UPDATE toggl SET consumed')]
+    equal(len(update), 1)
+    equal(update[0].rows, 50)
+
+    # Nothing is kept or logged individually unless sampled or slow
+    equal(len(tracer.records), 0)
+
+
+def test_query_tracer_slow_and_sampled():
+    tracer = QueryTracer(
+        slow_seconds=0.5, clock=FakeClock(step=1), sample=lambda: 1)
+    with _database(tracer) as db:
+        db.exec('''SELECT COUNT(*) FROM toggl''')
+    equal(len(tracer.records), 1)
+    equal(tracer.records[0].sql, '''SELECT COUNT(*) FROM toggl''')
+    equal(tracer.records[0].seconds, 1)
+
+    tracer = QueryTracer(
+        sample_rate=0.5, clock=FakeClock(step=0), sample=lambda: 0.25)
+    with _database(tracer) as db:
+        db.exec('''SELECT COUNT(*) FROM toggl''')
+        db.exec('''SELECT COUNT(*) FROM toggl''')
+    equal(len(tracer.records), 2)
+    equal(tracer.slowest(1)[0].calls, 2)